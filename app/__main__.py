@@ -1,3 +1,4 @@
+import signal
 import asyncio
 import logging
 import app.logger as logger
@@ -10,8 +11,13 @@ from app.settings import SETTINGS
 from app.middlewares import DatabaseMiddleware, ErrorMiddleware
 from app.routers import setup_error_handler
 from app.routers import router as main_router
-from app.setup.storage import get_events_isolation, get_storage
+from app.setup.storage import get_blob_store, get_events_isolation, get_lease_store, get_redis, get_storage
+from app.setup.webhook import start_webhook
 from app.utils.mongodb import MongoDB
+from app.utils.writer import BulkWriter
+from app.utils.blobs import Blobs
+from app.utils.cache import Cache
+from app.utils.queue import RequestLimitter
 from app.utils.payments import YookassaApi
 
 logger.setup()
@@ -31,6 +37,15 @@ async def main():
         SETTINGS.MONGODB_URL.get_secret_value(), 
         SETTINGS.MONGODB_DB.get_secret_value(),
     )
+    BulkWriter.setup(
+        SETTINGS.BULK_WRITE_MAX_SIZE,
+        SETTINGS.BULK_WRITE_INTERVAL,
+    )
+    Blobs.setup(get_blob_store())
+
+    # Setup state shared by the bot workers
+    RequestLimitter.setup(get_lease_store())
+    Cache.setup_sync(get_redis())
 
     dp = Dispatcher(
         storage=get_storage(),
@@ -38,10 +53,12 @@ async def main():
     )
 
     # Registering middlewares
+    # Outer middlewares run before filters, so the user snapshot loaded
+    # once per update is shared by all filters and the handler
     db_middleware = DatabaseMiddleware(MongoDB.get_database())
-    dp.message.middleware(db_middleware)
-    dp.callback_query.middleware(db_middleware)
-    dp.chat_member.middleware(db_middleware)
+    dp.message.outer_middleware(db_middleware)
+    dp.callback_query.outer_middleware(db_middleware)
+    dp.chat_member.outer_middleware(db_middleware)
     dp.errors.middleware(ErrorMiddleware())
 
     # Registering error handler
@@ -50,16 +67,34 @@ async def main():
     # Registering routers
     dp.include_router(main_router)
     
-    # Starting polling
+    dp.startup.register(handlers.on_startup)
+    dp.shutdown.register(handlers.on_shutdown)
+
     loop = asyncio.get_running_loop()
+    if SETTINGS.UPDATES_MODE == 'webhook':
+        # Starting webhook server
+        try:
+            runner = await start_webhook(dp, bot)
+        except ValueError as e:
+            logging.error(f'Failed to start webhook: {e}')
+            loop.stop()
+            return
+
+        async def stop():
+            await runner.cleanup()
+            loop.stop()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, lambda: loop.create_task(stop()))
+        return
+
+    # Starting polling
     loop.create_task(
         dp.start_polling(
             bot,
             allowed_updates=dp.resolve_used_update_types()        
         ),
     )
-
-    dp.startup.register(handlers.on_startup)
     
 if __name__ == "__main__":
     logging.warning("Starting bot")
@@ -1,8 +1,8 @@
 from aiogram.filters import BaseFilter
 from aiogram.types import Message
 
-from app.utils.cache import Cache
 from app.utils.enums import UserRole
+from app.utils.mongo_user import UserData
 
 class RoleFilter(BaseFilter):
     required_role: UserRole | list
@@ -11,10 +11,12 @@ class RoleFilter(BaseFilter):
         ''' required_value: UserRole | List[UserRole] '''
         self.required_role = required_role
 
-    async def __call__(self, message: Message) -> bool:
-        cached_user = await Cache.get_user(message.from_user)
+    async def __call__(self, message: Message, user_data: UserData = None) -> bool:
+        # No snapshot outside of private chats
+        if user_data is None:
+            return False
         if isinstance(self.required_role, UserRole):
-            return cached_user.role == self.required_role
+            return user_data.role == self.required_role
         elif isinstance(self.required_role, list):
-            return cached_user.role in self.required_role
+            return user_data.role in self.required_role
         return False
\ No newline at end of file
@@ -1,7 +1,7 @@
 from aiogram.filters import BaseFilter
 from aiogram.types import Message
 
-from app.utils.mongodb import MongoDB
+from app.utils.mongo_user import UserData
 
 
 class UserSettingsFilter(BaseFilter):
@@ -31,21 +31,26 @@ class UserSettingsFilter(BaseFilter):
         self.document = document
         self.gpt_role = gpt_role
 
-    async def __call__(self, message: Message) -> bool:
-        user_raw_data = await MongoDB.get_user(message.from_user.id)
+    async def __call__(self, message: Message, user_data: UserData = None) -> bool:
+        '''
+        Matches against the user snapshot loaded by `DatabaseMiddleware`.
+        '''
+        if user_data is None:
+            return False
+        settings = user_data.settings
         flag = True
-        if self.img_model is not None and self.img_model != user_raw_data['settings']['image_model']:
+        if self.img_model is not None and self.img_model != settings.image_model:
             flag = False
-        if self.text_model is not None and self.text_model != user_raw_data['settings']['text_model']:
+        if self.text_model is not None and self.text_model != settings.text_model:
             flag = False
-        if self.dialogue_mode is not None and self.dialogue_mode != user_raw_data['settings']['dialogue_mode']:
+        if self.dialogue_mode is not None and self.dialogue_mode != settings.dialogue_mode:
             flag = False
-        if self.stream_mode is not None and self.stream_mode != user_raw_data['settings']['stream_mode']:
+        if self.stream_mode is not None and self.stream_mode != settings.stream_mode:
             flag = False
-        if self.language_code is not None and self.language_code != user_raw_data['settings']['language_code']:
+        if self.language_code is not None and self.language_code != settings.language_code:
             flag = False
-        if self.document is not None and self.document != user_raw_data['settings']['document']:
+        if self.document is not None and self.document != settings.document:
             flag = False
-        if self.gpt_role is not None and self.gpt_role != user_raw_data['settings']['gpt_role']:
+        if self.gpt_role is not None and self.gpt_role != settings.gpt_role:
             flag = False
         return flag
\ No newline at end of file
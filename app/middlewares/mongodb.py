@@ -1,13 +1,13 @@
-from datetime import datetime
 from typing import Callable, Any, Awaitable, Dict
 
 from aiogram.enums.chat_member_status import ChatMemberStatus
-from aiogram.types import Message
+from aiogram.enums.chat_type import ChatType
+from aiogram.types import Message, ChatMemberUpdated
 from aiogram import BaseMiddleware
 
 from pymongo.database import Database
-from app.utils.mongo_user import UserData
-from app.utils.mongodb import MongoDB
+from app.utils.cache import Cache
+from app.utils.catalog import SubscriptionCatalog
 
 class DatabaseMiddleware(BaseMiddleware):
     db: Database
@@ -24,31 +24,23 @@ class DatabaseMiddleware(BaseMiddleware):
         event: Message,
         data: Dict[str, Any]
     ) -> Any:
+        # Channel membership updates are not from bot users
+        if isinstance(event, ChatMemberUpdated):
+            return await handler(event, data)
         message = event.message if not hasattr(event, 'chat') else event
+        # Bot users are served in private chats only, group updates
+        # must not register users or get the welcome and ban texts
+        if message is None or message.chat.type != ChatType.PRIVATE:
+            return await handler(event, data)
         user = event.from_user
 
-        user_data = None
-        raw_user_data = await MongoDB.get_user(user.id)
+        user_data, created = await Cache.get_user(user)
         # If user is not in database
-        if (raw_user_data == None):
+        if created:
             text  = "<b>Бот запущен в тестовом режиме!</b>\n"
             text += "Подпишитесь на канал @studgpt, чтобы своевременно получать иформацию об обновлениях. "
             text += "Там же можно оставить отзыв о работе бота."
             await message.answer(text)
-            user_data = UserData(
-                _id = None,
-                user_id = user.id,
-                reg_date = datetime.now(),
-                last_update = datetime.now(),
-                username = user.username,
-                first_name = user.first_name,
-                last_name = user.last_name
-            )
-            await MongoDB.get_database().tg_users.insert_one(user_data.as_dict())
-        
-        # If user in database
-        else:
-            user_data = UserData(**raw_user_data)
         
         # User are banned
         if user_data.banned == True:
@@ -56,20 +48,10 @@ class DatabaseMiddleware(BaseMiddleware):
             return
         
         # Get user sub
-        sub = await MongoDB.get_subscription_by_name(user_data.subscription.name)
+        sub = SubscriptionCatalog.get_by_name(user_data.subscription.name)
 
-        # Reset quota
-        if user_data.last_update.date() < datetime.now().date():
-            await MongoDB.update_field(
-                _id = user_data._id,
-                path = ('subscription', 'quota'),
-                value = sub.get('quota')
-            )
-            await MongoDB.set_last_update(user_data._id)
-            # NOTE: Сообщение о сбросе квоты
-            await message.answer(f"Вам снова доступно {sub.get('quota')} запросов!")
-        
         # Return data
+        # This snapshot is shared by all filters and the handler of the update
         data['user_data'] = user_data
         data['subscription'] = sub
         return await handler(event, data)
\ No newline at end of file
@@ -10,6 +10,7 @@ from aiogram.types import BufferedInputFile
 
 from .admin.admin import router as admin_router
 from .base.start import router as start_router
+from .base.membership import router as membership_router
 from .gpt.chatgpt import router as chatgpt_router
 from .gpt.gemini import router as gemini_router
 from .gpt.imagine import router as imagine_router
@@ -20,6 +21,7 @@ __bot = None
 router = Router()
 
 router.include_router(start_router)
+router.include_router(membership_router)
 router.include_router(admin_router)
 router.include_router(imagine_router)
 router.include_router(gemini_router)
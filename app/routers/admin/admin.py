@@ -9,6 +9,9 @@ from app.filters import RoleFilter
 from app.utils.enums import UserRole
 from app.utils.mongodb import MongoDB
 from app.utils.mongo_user import UserData
+from app.utils.http import HttpClients
+from app.utils.resilience import CircuitBreaker
+from app.utils.prompt_rules import PromptRules
 
 router = Router()
 
@@ -57,4 +60,39 @@ async def test_sub_command_handler(
     user_data: UserData
 ) -> None:
     await user_data.add_subscription("Test Subscription", "No", 150, 1)
-    await message.reply('Added Test Subscription')
\ No newline at end of file
+    await message.reply('Added Test Subscription')
+@router.message(
+    RoleFilter(required_role=UserRole.ADMIN),
+    Command(commands={"http"})
+)
+async def http_stats_command_handler(
+    message: Message,
+    command: CommandObject,
+    user_data: UserData
+) -> None:
+    lines = []
+    for name, stats in HttpClients.get_stats().items():
+        lines.append(
+            f"<b>{name}</b>: {stats['in_use']} in use (max {stats['max_in_use']}), "
+            f"{stats['requests']} requests, {stats['errors']} errors, "
+            f"wait {stats['wait_avg'] * 1000:.0f}ms avg / {stats['wait_max'] * 1000:.0f}ms max"
+        )
+    for name, breaker in CircuitBreaker.breakers.items():
+        stats = breaker.get_stats()
+        lines.append(
+            f"<b>{name}</b> circuit: {stats['state']}, {stats['failures']} failures, "
+            f"latency {stats['latency']:.1f}s, error rate {stats['error_rate']:.0%}"
+        )
+    await message.reply("\n".join(lines) or "No requests yet", parse_mode="HTML")
+
+@router.message(
+    RoleFilter(required_role=UserRole.ADMIN),
+    Command(commands={"rules"})
+)
+async def reload_rules_command_handler(
+    message: Message,
+    command: CommandObject,
+    user_data: UserData
+) -> None:
+    changed = await PromptRules.load()
+    await message.reply(f"Imagine rules: {len(PromptRules.rules)}" + (" (reloaded)" if changed else ""))
@@ -0,0 +1,14 @@
+from aiogram import F, Router
+from aiogram.types import ChatMemberUpdated
+
+from app.settings import SETTINGS
+from app.utils.cache import Membership
+
+router = Router()
+
+@router.chat_member(
+    F.chat.id == SETTINGS.MEMBERSHIP_CHANNEL_ID
+)
+async def channel_member_handler(event: ChatMemberUpdated) -> None:
+    # The bot has to be an admin of the channel to receive these updates
+    Membership.update(event.new_chat_member.user.id, event.new_chat_member)
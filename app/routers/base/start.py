@@ -10,6 +10,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup, default_state
 
 from app.utils.mongodb import MongoDB
+from app.utils.catalog import SubscriptionCatalog
 from app.utils.mongo_user import UserData
 import app.utils.payments as payments
 
@@ -142,7 +143,7 @@ async def switch_to_web_callback(message: Message, user_data: UserData) -> None:
     )
 )
 async def my_profile_callback(message: Message, user_data: UserData) -> None:
-    sub = await MongoDB.get_subscription_by_name(user_data.subscription.name)
+    sub = SubscriptionCatalog.get_by_name(user_data.subscription.name)
     quota = sub.get('quota', 0)
     remains = user_data.subscription.quota
     msg = f"""
@@ -232,9 +233,9 @@ async def buy_subscription_callback(query: CallbackQuery, user_data: UserData, s
         await query.message.edit_text("<b>👨‍💻 Пришлите свой адрес электронной почты ⤵️</b>\nЭто необходимо для доставки чека после приобретения подписки.", reply_markup=kb.as_markup(), parse_mode="HTML")
         return
     if query.data == "buy_start_subscription":
-        sub = await MongoDB.get_subscription_by_name("Старт")
+        sub = SubscriptionCatalog.get_by_name("Старт")
     elif query.data == "buy_pro_subscription":
-        sub = await MongoDB.get_subscription_by_name("Продвинутый")
+        sub = SubscriptionCatalog.get_by_name("Продвинутый")
     
     msg = f"""
 <b>💳 Приобретение тарифа {sub.get('name')}</b>
@@ -368,12 +369,16 @@ async def settings_callback(message: Message, user_data: UserData) -> None:
 @router.callback_query(
     or_f(
         F.data == "settings_text_generation",
+        F.data == "toggle_stream_mode",
         F.data.startswith("set_langmodel_")
     )
 )
 async def settings_text_generation_callback(query: CallbackQuery, user_data: UserData) -> None:
     await query.answer()
 
+    if query.data == "toggle_stream_mode":
+        await user_data.settings.set_stream_mode(not user_data.settings.stream_mode)
+
     if query.data.startswith("set_langmodel_"):
         model = query.data.split("_")[-1]
         if model == 'gpt4':
@@ -397,11 +402,15 @@ async def settings_text_generation_callback(query: CallbackQuery, user_data: Use
 🥶 <b>ChatGPT 4</b> {"✔️" if user_data.settings.text_model == 'gpt4' else ''} (<i>временно недоступна</i>)
 ├ Самая совершенная модель
 └ Анализ изображений
+
+⚡️ <b>Потоковый режим</b> {"✔️" if user_data.settings.stream_mode else ''}
+└ Ответ появляется по мере генерации
 """
     kb = InlineKeyboardBuilder()
     kb.button(text="Gemini", callback_data="set_langmodel_gemini")
     kb.button(text="GPT 3.5 Turbo", callback_data="set_langmodel_gpt-3.5-turbo")
     kb.button(text="GPT 4", callback_data="set_langmodel_gpt4", )
+    kb.button(text="Потоковый режим", callback_data="toggle_stream_mode")
     # kb.button(text="Назад", callback_data="switch_to_settings")
     kb.adjust(3, 1)
     await query.message.edit_text(msg, reply_markup=kb.as_markup(), parse_mode="HTML")
@@ -1,28 +1,26 @@
 from aiogram import F, Router
 from aiogram.types import Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.enums.chat_member_status import ChatMemberStatus
 
 from app.settings import SETTINGS
 from app.filters import UserSettingsFilter
 
 from app.utils.mongo_user import UserData
+from app.utils.cache import Membership
 from app.utils.openai import *
+from app.utils.failover import put_text_completion, OPENAI
 
 router = Router()
 
 @router.message(
     UserSettingsFilter(
-        stream_mode = False,
         text_model='gpt-3.5-turbo'
     ),
     F.chat.type == "private"
 )
 async def gpt_message_handler(message: Message, user_data: UserData) -> None:
     # Only if user is chat member
-    user = message.from_user
-    member = await message.bot.get_chat_member(-1002076481867, user.id)
-    if member is None or member.status in [ChatMemberStatus.KICKED, ChatMemberStatus.LEFT, ChatMemberStatus.RESTRICTED]:
+    if not await Membership.is_member(message.bot, message.from_user.id):
         msg = """
 💬Подпишитесь на официальный канал @studgpt, чтобы получить доступ к бесплатным запросам.   
 
@@ -54,13 +52,16 @@ async def gpt_message_handler(message: Message, user_data: UserData) -> None:
     # Starting generating response
     msg = await message.reply("⏳ Запрос выполняется, пожалуйста, подождите...")
     # If user send text
-    ok = await put_chat_completion(
-        user_data=user_data, 
+    position = await put_text_completion(
+        user_data=user_data,
+        backend=OPENAI,
         prompt=message.text, 
         answer_message=msg,
         replied_message_id=message.reply_to_message.message_id if message.reply_to_message else None
     )
-    if not ok: 
+    if not position: 
         await msg.edit_text("❗️<b>Мы уже выполняем ваш запрос</b>", parse_mode="HTML")
         await asyncio.sleep(5)
-        await msg.delete()
\ No newline at end of file
+        await msg.delete()
+    elif position > 1:
+        await msg.edit_text(f"⏳ Примерная позиция в очереди: <b>{position}</b>. Пожалуйста, подождите...", parse_mode="HTML")
\ No newline at end of file
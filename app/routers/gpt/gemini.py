@@ -1,22 +1,20 @@
-import io
-import base64
-
 from aiogram import F, Router
 from aiogram.types import Message
-from aiogram.enums.chat_member_status import ChatMemberStatus
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from app.settings import SETTINGS
 from app.filters import UserSettingsFilter
 
 from app.utils.mongo_user import UserData
+from app.utils.cache import Membership
+from app.utils.images import download_photo
 from app.utils.gemini import *
+from app.utils.failover import put_text_completion, GEMINI
 
 router = Router()
 
 @router.message(
     UserSettingsFilter(
-        stream_mode = False,
         text_model='gemini'
     ),
     F.photo == None,
@@ -24,9 +22,7 @@ router = Router()
 )
 async def gpt_message_handler(message: Message, user_data: UserData) -> None:
     # Only if user is chat member
-    user = message.from_user
-    member = await message.bot.get_chat_member(-1002076481867, user.id)
-    if member is None or member.status in [ChatMemberStatus.KICKED, ChatMemberStatus.LEFT, ChatMemberStatus.RESTRICTED]:
+    if not await Membership.is_member(message.bot, message.from_user.id):
         msg = """
 💬Подпишитесь на официальный канал @studgpt, чтобы получить доступ к бесплатным запросам.   
 
@@ -58,21 +54,23 @@ async def gpt_message_handler(message: Message, user_data: UserData) -> None:
     # Starting generating response
     msg = await message.reply("⏳ Запрос выполняется, пожалуйста, подождите...")
     # If user send text
-    ok = await put_chat_completion(
-        user_data=user_data, 
+    position = await put_text_completion(
+        user_data=user_data,
+        backend=GEMINI,
         prompt=message.text, 
         answer_message=msg,
         replied_message_id=message.reply_to_message.message_id if message.reply_to_message else None
     )
-    if not ok: 
+    if not position: 
         await msg.edit_text("❗️<b>Мы уже выполняем ваш запрос</b>", parse_mode="HTML")
         await asyncio.sleep(5)
         await msg.delete()
+    elif position > 1:
+        await msg.edit_text(f"⏳ Примерная позиция в очереди: <b>{position}</b>. Пожалуйста, подождите...", parse_mode="HTML")
 
 
 @router.message(
     UserSettingsFilter(
-        stream_mode = False,
         text_model='gemini'
     ),
     F.photo != None,
@@ -87,9 +85,7 @@ async def gemini_photo_handler(message: Message, user_data: UserData, subscripti
         await message.answer("Чтобы воспользоваться анализом изображений, <b>Вам необходимо оплатить подписку 🫶</b>", reply_markup=kb.as_markup(), parse_mode="HTML")
         return
     # Only if user is chat member
-    user = message.from_user
-    member = await message.bot.get_chat_member(-1002076481867, user.id)
-    if member is None or member.status in [ChatMemberStatus.KICKED, ChatMemberStatus.LEFT, ChatMemberStatus.RESTRICTED]:
+    if not await Membership.is_member(message.bot, message.from_user.id):
         msg = """
 💬Подпишитесь на официальный канал @studgpt, чтобы получить доступ к бесплатным запросам.   
 
@@ -109,11 +105,8 @@ async def gemini_photo_handler(message: Message, user_data: UserData, subscripti
         kb.button(text="✨ Увеличить количество запросов", callback_data="switch_to_subscriptions")
         await message.answer(msg, parse_mode="HTML", reply_markup=kb.as_markup())
         return
-    # Photo to base64
-    binary = io.BytesIO()
-    await message.bot.download(file=message.photo[-1].file_id, destination=binary)
-    # BinaryIO image to base64
-    base64_image = base64.b64encode(binary.read()).decode('utf-8')
+    # Largest photo size that fits the limits, downloaded into a single buffer
+    photo = await download_photo(message.bot, message.photo, SETTINGS.IMAGE_MAX_SIDE, SETTINGS.IMAGE_MAX_BYTES)
     # Starting generating response
     msg = "⏳ Запрос выполняется, пожалуйста, подождите..."
     if message.reply_to_message is not None:
@@ -121,13 +114,16 @@ async def gemini_photo_handler(message: Message, user_data: UserData, subscripti
     msg = await message.reply(msg, parse_mode="HTML")
     caption = message.caption if message.caption is not None else "Опиши подробно, что изображено на фото"
     # If user send text
-    ok = await put_analyze_photo(
+    position = await put_analyze_photo(
         user_data=user_data, 
         prompt=caption, 
-        base64_photo=base64_image,
-        answer_message=msg
+        photo=photo,
+        answer_message=msg,
+        file_id=message.photo[-1].file_id
     )
-    if not ok: 
+    if not position: 
         await msg.edit_text("❗️<b>Мы уже выполняем ваш запрос</b>", parse_mode="HTML")
         await asyncio.sleep(5)
         await msg.delete()
+    elif position > 1:
+        await msg.edit_text(f"⏳ Примерная позиция в очереди: <b>{position}</b>. Пожалуйста, подождите...", parse_mode="HTML")
@@ -2,7 +2,7 @@ import io
 import base64
 
 from aiogram import F, Router
-from aiogram.types import Message
+from aiogram.types import Message, CallbackQuery
 from aiogram.enums.chat_member_status import ChatMemberStatus
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
@@ -16,7 +16,6 @@ router = Router()
 
 @router.message(
     UserSettingsFilter(
-        stream_mode = False,
         text_model='imagine'
     ),
     F.photo == None,
@@ -45,13 +44,40 @@ async def gpt_message_handler(message: Message, user_data: UserData) -> None:
     # Starting generating response
     msg = await message.reply("⏳ Запрос выполняется, пожалуйста, подождите...")
     # If user send text
-    ok = await put_chat_completion(
+    position = await put_chat_completion(
         user_data=user_data, 
         prompt=message.text, 
         answer_message=msg,
         replied_message_id=message.reply_to_message.message_id if message.reply_to_message else None
     )
-    if not ok: 
+    if not position: 
         await msg.edit_text("❗️<b>Мы уже выполняем ваш запрос</b>", parse_mode="HTML")
         await asyncio.sleep(5)
-        await msg.delete()
\ No newline at end of file
+        await msg.delete()
+    elif position > 1:
+        await msg.edit_text(f"⏳ Примерная позиция в очереди: <b>{position}</b>. Пожалуйста, подождите...", parse_mode="HTML")
+
+@router.callback_query(
+    F.data.startswith("imagine_variation:")
+)
+async def imagine_variation_callback(callback: CallbackQuery, user_data: UserData) -> None:
+    # If user has quota
+    if not user_data.subscription.has_quota():
+        await callback.answer("😢 Вы достигли лимита запросов на сегодня.", show_alert=True)
+        return
+    await callback.answer()
+    msg = await callback.message.answer("⏳ Запрос выполняется, пожалуйста, подождите...")
+    position = await put_variation(
+        user_data=user_data,
+        image_key=callback.data.split(":", 1)[1],
+        answer_message=msg,
+        chat_id=callback.message.chat.id
+    )
+    if position is None:
+        await msg.edit_text("❗️Изображение устарело, отправьте запрос заново")
+    elif not position:
+        await msg.edit_text("❗️<b>Мы уже выполняем ваш запрос</b>", parse_mode="HTML")
+        await asyncio.sleep(5)
+        await msg.delete()
+    elif position > 1:
+        await msg.edit_text(f"⏳ Примерная позиция в очереди: <b>{position}</b>. Пожалуйста, подождите...", parse_mode="HTML")
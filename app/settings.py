@@ -17,6 +17,8 @@ class Settings(BaseSettings):
     CHAT_COMPLETION_MAX_TOKENS: int = int(getenv('CHAT_COMPLETION_MAX_TOKENS'))
     CHAT_COMPLETION_TIMEOUT: int = int(getenv('CHAT_COMPLETION_TIMEOUT'))
     CHAT_COMPLETION_STREAM_INTERVAL: float = float(getenv('CHAT_COMPLETION_STREAM_INTERVAL'))
+    DIALOGUE_MAX_TURNS: int = int(getenv('DIALOGUE_MAX_TURNS', 20))
+    ENCODINGS_RETRY_INTERVAL: float = float(getenv('ENCODINGS_RETRY_INTERVAL', 60))
     DEFAULT_GPT_MODEL: str = getenv('DEFAULT_GPT_MODEL')
     DEFAULT_IMG_MODEL: str = getenv('DEFAULT_IMG_MODEL')
 
@@ -26,4 +28,74 @@ class Settings(BaseSettings):
 
     FAL_AI_API_KEY: SecretStr = SecretStr(getenv('FAL_AI_API_KEY'))
 
+    QUEUE_GENERAL_WEIGHT: int = int(getenv('QUEUE_GENERAL_WEIGHT', 1))
+    QUEUE_PREMIUM_WEIGHT: int = int(getenv('QUEUE_PREMIUM_WEIGHT', 2))
+    QUEUE_MAX_WAIT: float = float(getenv('QUEUE_MAX_WAIT', 30))
+
+    REQUEST_LEASE_TTL: float = float(getenv('REQUEST_LEASE_TTL', 600))
+    TEXT_REQUESTS_PER_USER: int = int(getenv('TEXT_REQUESTS_PER_USER', 1))
+    IMAGE_REQUESTS_PER_USER: int = int(getenv('IMAGE_REQUESTS_PER_USER', 1))
+    IMAGE_MAX_SIDE: int = int(getenv('IMAGE_MAX_SIDE', 1280))
+    IMAGE_MAX_BYTES: int = int(getenv('IMAGE_MAX_BYTES', 4 * 1024 * 1024))
+
+    OPENAI_WORKERS: int = int(getenv('OPENAI_WORKERS', 8))
+    OPENAI_RPS: float = float(getenv('OPENAI_RPS', 0))
+    GEMINI_WORKERS: int = int(getenv('GEMINI_WORKERS', 8))
+    GEMINI_RPS: float = float(getenv('GEMINI_RPS', 0))
+    FALAI_WORKERS: int = int(getenv('FALAI_WORKERS', 4))
+    FALAI_RPS: float = float(getenv('FALAI_RPS', 0))
+    IMAGINE_REWRITE_WORKERS: int = int(getenv('IMAGINE_REWRITE_WORKERS', 4))
+    IMAGINE_REWRITE_RPS: float = float(getenv('IMAGINE_REWRITE_RPS', 0))
+    IMAGINE_UPLOAD_WORKERS: int = int(getenv('IMAGINE_UPLOAD_WORKERS', 4))
+    IMAGINE_NUM_IMAGES: int = int(getenv('IMAGINE_NUM_IMAGES', 1))
+    IMAGINE_CACHE_SIZE: int = int(getenv('IMAGINE_CACHE_SIZE', 1000))
+    IMAGINE_CACHE_TTL: float = float(getenv('IMAGINE_CACHE_TTL', 86400))
+    IMAGINE_RULES_RELOAD_INTERVAL: float = float(getenv('IMAGINE_RULES_RELOAD_INTERVAL', 60))
+
+    HTTP_CONNECT_TIMEOUT: float = float(getenv('HTTP_CONNECT_TIMEOUT', 10))
+    HTTP_READ_TIMEOUT: float = float(getenv('HTTP_READ_TIMEOUT', 60))
+    HTTP_POOL_TIMEOUT: float = float(getenv('HTTP_POOL_TIMEOUT', 30))
+    HTTP_KEEPALIVE_EXPIRY: float = float(getenv('HTTP_KEEPALIVE_EXPIRY', 30))
+    PROVIDER_RETRY_ATTEMPTS: int = int(getenv('PROVIDER_RETRY_ATTEMPTS', 3))
+    PROVIDER_RETRY_MAX_DELAY: float = float(getenv('PROVIDER_RETRY_MAX_DELAY', 10))
+    CIRCUIT_FAILURE_THRESHOLD: int = int(getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+    CIRCUIT_RESET_TIMEOUT: float = float(getenv('CIRCUIT_RESET_TIMEOUT', 30))
+    GEMINI_HEDGE_DELAY: float = float(getenv('GEMINI_HEDGE_DELAY', 0))
+
+    TEXT_FAILOVER: bool = getenv('TEXT_FAILOVER', '1') == '1'
+    TEXT_QUEUE_WAIT_SLO: float = float(getenv('TEXT_QUEUE_WAIT_SLO', 20))
+    TEXT_FAILOVER_ERROR_RATE: float = float(getenv('TEXT_FAILOVER_ERROR_RATE', 0.5))
+    FAILOVER_OPENAI_MODEL: str = getenv('FAILOVER_OPENAI_MODEL', 'gpt-3.5-turbo')
+
+    BULK_WRITE_MAX_SIZE: int = int(getenv('BULK_WRITE_MAX_SIZE', 100))
+    BULK_WRITE_INTERVAL: float = float(getenv('BULK_WRITE_INTERVAL', 1))
+
+    STORAGE: str = getenv('STORAGE', 'memory')
+    REDIS_URL: SecretStr = SecretStr(getenv('REDIS_URL', 'redis://localhost:6379/0'))
+    REDIS_MAX_CONNECTIONS: int = int(getenv('REDIS_MAX_CONNECTIONS', 20))
+    REDIS_RETRY_INTERVAL: float = float(getenv('REDIS_RETRY_INTERVAL', 5))
+    FSM_TTL: int = int(getenv('FSM_TTL', 0))
+
+    BLOB_STORE: str = getenv('BLOB_STORE', 'gridfs')
+    BLOB_STORE_PATH: str = getenv('BLOB_STORE_PATH', 'blobs')
+
+    USER_CACHE_SIZE: int = int(getenv('USER_CACHE_SIZE', 10000))
+    USER_CACHE_TTL: float = float(getenv('USER_CACHE_TTL', 300))
+    MEMBERSHIP_CHANNEL_ID: int = int(getenv('MEMBERSHIP_CHANNEL_ID', -1002076481867))
+    MEMBERSHIP_TTL: float = float(getenv('MEMBERSHIP_TTL', 300))
+    MEMBERSHIP_NEGATIVE_TTL: float = float(getenv('MEMBERSHIP_NEGATIVE_TTL', 30))
+    SUBSCRIPTIONS_RELOAD_INTERVAL: float = float(getenv('SUBSCRIPTIONS_RELOAD_INTERVAL', 60))
+    QUOTA_RESET_TIMEZONE: str = getenv('QUOTA_RESET_TIMEZONE', 'Europe/Moscow')
+    QUOTA_RESET_RETRY_INTERVAL: float = float(getenv('QUOTA_RESET_RETRY_INTERVAL', 60))
+
+    UPDATES_MODE: str = getenv('UPDATES_MODE', 'polling')
+    WEBHOOK_URL: str = getenv('WEBHOOK_URL', '')
+    WEBHOOK_PATH: str = getenv('WEBHOOK_PATH', '/webhook')
+    WEBHOOK_SECRET: SecretStr = SecretStr(getenv('WEBHOOK_SECRET', ''))
+    WEBHOOK_HOST: str = getenv('WEBHOOK_HOST', '0.0.0.0')
+    WEBHOOK_PORT: int = int(getenv('WEBHOOK_PORT', 8080))
+    WEBHOOK_MAX_CONNECTIONS: int = int(getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+    WEBHOOK_MAX_TASKS: int = int(getenv('WEBHOOK_MAX_TASKS', 100))
+    WEBHOOK_DRAIN_TIMEOUT: float = float(getenv('WEBHOOK_DRAIN_TIMEOUT', 30))
+
 SETTINGS = Settings()
\ No newline at end of file
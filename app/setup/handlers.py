@@ -1,4 +1,5 @@
 import asyncio
+import logging
 import app.utils.payments as payments
 
 from datetime import datetime, timedelta
@@ -7,6 +8,14 @@ from aiogram import Bot
 from app.settings import SETTINGS
 from app.utils.mongodb import MongoDB
 from app.utils.cache import Cache
+from app.utils.writer import BulkWriter
+from app.utils.dialogue import DialogueStore
+from app.utils.context import load_encodings
+from app.utils.http import HttpClients
+from app.utils.prompt_rules import PromptRules
+from app.utils.catalog import SubscriptionCatalog
+from app.utils.quota import QuotaReset
+from app.setup.storage import close_redis
 
 from app.utils.gemini import executor as gemini_executor
 from app.utils.openai import executor as openai_executor
@@ -19,7 +28,7 @@ def set_bot(bot: Bot):
     BOT = bot
 
 async def payment_status_changed_handler(payment: dict):
-    sub = await MongoDB.get_subscription_by_name(payment.get('product'))
+    sub = SubscriptionCatalog.get_by_name(payment.get('product'))
     user_data = await MongoDB.get_user(payment.get('user_id'))
     if payment.get('status') == 'succeeded':
         await BOT.send_message(SETTINGS.LOGGING_CHAT, f"""New subscriber {user_data['first_name']} (<code>{user_data['user_id']}</code>)\nSubscription {payment.get('product')}: {payment.get('price')} RUB""", parse_mode="HTML")
@@ -40,10 +49,38 @@ async def payment_status_changed_handler(payment: dict):
             })
         await Cache.clear_user(user_data['user_id'])
 
+async def load_encodings_loop():
+    '''
+    Token counts are estimated until the encodings are loaded
+    '''
+    while True:
+        try:
+            await asyncio.to_thread(load_encodings)
+            return
+        except Exception as e:
+            logging.error(f'Failed to load token encodings: {e!r}')
+            await asyncio.sleep(SETTINGS.ENCODINGS_RETRY_INTERVAL)
+
 async def on_startup():
     loop = asyncio.get_running_loop()
+    await DialogueStore.setup()
+    await PromptRules.load()
+    await SubscriptionCatalog.load()
+    await QuotaReset.setup()
     payments.register_payment_status_changed_handler(payment_status_changed_handler)
     loop.create_task(payments.check_payment_loop())
     loop.create_task(gemini_executor())
     loop.create_task(openai_executor())
-    loop.create_task(falai_executor())
\ No newline at end of file
+    loop.create_task(falai_executor())
+    loop.create_task(BulkWriter.flush_loop())
+    loop.create_task(load_encodings_loop())
+    loop.create_task(PromptRules.reload_loop(SETTINGS.IMAGINE_RULES_RELOAD_INTERVAL))
+    loop.create_task(SubscriptionCatalog.watch(SETTINGS.SUBSCRIPTIONS_RELOAD_INTERVAL))
+    loop.create_task(QuotaReset.reset_loop())
+    if Cache.is_synced():
+        loop.create_task(Cache.sync_loop())
+
+async def on_shutdown():
+    await BulkWriter.flush()
+    await HttpClients.close()
+    await close_redis()
\ No newline at end of file
@@ -1,10 +1,59 @@
 from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
 
+from app.settings import SETTINGS
+from app.utils.blobs import BlobStore, FileBlobStore, GridFSBlobStore
+from app.utils.queue import LeaseStore, MemoryLeaseStore, RedisLeaseStore
+
+REDIS = None
+
+
+def get_redis():
+    '''
+    Returns the redis client shared by the FSM storage, the limiter and the cache,
+    None unless `STORAGE` is `redis`. Created on first use with one connection pool.
+    '''
+    global REDIS
+    if SETTINGS.STORAGE != 'redis':
+        return None
+    if REDIS is None:
+        # Optional dependency, needed only with the redis storage
+        from redis.asyncio import ConnectionPool, Redis
+        REDIS = Redis(connection_pool=ConnectionPool.from_url(
+            SETTINGS.REDIS_URL.get_secret_value(),
+            max_connections=SETTINGS.REDIS_MAX_CONNECTIONS
+        ))
+    return REDIS
+
+
+async def close_redis():
+    global REDIS
+    if REDIS is not None:
+        redis, REDIS = REDIS, None
+        await redis.aclose(close_connection_pool=True)
+
 
 def get_storage() -> BaseStorage:
+    if SETTINGS.STORAGE == 'redis':
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage(get_redis(), state_ttl=SETTINGS.FSM_TTL or None, data_ttl=SETTINGS.FSM_TTL or None)
     return MemoryStorage()
 
 
 def get_events_isolation() -> BaseEventIsolation:
-    return SimpleEventIsolation()
\ No newline at end of file
+    if SETTINGS.STORAGE == 'redis':
+        from aiogram.fsm.storage.redis import RedisEventIsolation
+        return RedisEventIsolation(get_redis())
+    return SimpleEventIsolation()
+
+
+def get_lease_store() -> LeaseStore:
+    if SETTINGS.STORAGE == 'redis':
+        return RedisLeaseStore(get_redis())
+    return MemoryLeaseStore()
+
+
+def get_blob_store() -> BlobStore:
+    if SETTINGS.BLOB_STORE == 'file':
+        return FileBlobStore(SETTINGS.BLOB_STORE_PATH)
+    return GridFSBlobStore()
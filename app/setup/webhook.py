@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import ipaddress
+
+from typing import Any, Optional
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from app.settings import SETTINGS
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    '''
+    Answers Telegram with 200 as soon as the update is read and processes it in the background.
+    At most `max_tasks` updates are processed at once, further requests wait for a free slot,
+    so a burst is held back by Telegram instead of piling up tasks in memory.
+    On shutdown the running updates are drained before the bot session is closed.
+    '''
+    semaphore: asyncio.Semaphore
+    drain_timeout: float
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_tasks: int, drain_timeout: float, secret_token: Optional[str] = None, **data: Any) -> None:
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.semaphore = asyncio.Semaphore(max_tasks)
+        self.drain_timeout = drain_timeout
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self.semaphore.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def drain(self):
+        '''
+        Waits up to `drain_timeout` seconds for the updates in progress, cancels the rest
+        '''
+        if not self._background_feed_update_tasks:
+            return
+        logging.warning(f'Draining {len(self._background_feed_update_tasks)} updates')
+        deadline = asyncio.get_running_loop().time() + self.drain_timeout
+        # Requests still waiting for a slot may add tasks while draining
+        while self._background_feed_update_tasks:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            await asyncio.wait(set(self._background_feed_update_tasks), timeout=timeout)
+        pending = set(self._background_feed_update_tasks)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.error(f'{len(pending)} updates were cancelled on shutdown')
+
+    async def close(self):
+        await self.drain()
+        await super().close()
+
+def is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+async def start_webhook(dp: Dispatcher, bot: Bot) -> web.AppRunner:
+    '''
+    Starts the webhook server on `WEBHOOK_HOST:WEBHOOK_PORT`.
+    The webhook is registered in Telegram only if `WEBHOOK_URL` is set,
+    without it updates can be posted to `WEBHOOK_PATH` by hand.
+    `WEBHOOK_SECRET` is required, otherwise anyone who reaches the port could post forged updates.
+    Only local replay (no `WEBHOOK_URL`, loopback `WEBHOOK_HOST`) may go without it.
+    '''
+    if not SETTINGS.WEBHOOK_SECRET.get_secret_value():
+        if SETTINGS.WEBHOOK_URL:
+            raise ValueError('WEBHOOK_SECRET is required when WEBHOOK_URL is set')
+        if not is_loopback(SETTINGS.WEBHOOK_HOST):
+            raise ValueError(f'WEBHOOK_SECRET is required to listen on {SETTINGS.WEBHOOK_HOST}')
+    app = web.Application()
+    handler = BoundedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        max_tasks=SETTINGS.WEBHOOK_MAX_TASKS,
+        drain_timeout=SETTINGS.WEBHOOK_DRAIN_TIMEOUT,
+        secret_token=SETTINGS.WEBHOOK_SECRET.get_secret_value() or None
+    )
+    # Registered before the dispatcher, so updates are drained before its shutdown handlers run
+    handler.register(app, path=SETTINGS.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    if SETTINGS.WEBHOOK_URL:
+        async def set_webhook():
+            await bot.set_webhook(
+                url=SETTINGS.WEBHOOK_URL.rstrip('/') + SETTINGS.WEBHOOK_PATH,
+                secret_token=SETTINGS.WEBHOOK_SECRET.get_secret_value() or None,
+                max_connections=SETTINGS.WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+        dp.startup.register(set_webhook)
+
+    runner = web.AppRunner(app, shutdown_timeout=SETTINGS.WEBHOOK_DRAIN_TIMEOUT)
+    await runner.setup()
+    site = web.TCPSite(runner, SETTINGS.WEBHOOK_HOST, SETTINGS.WEBHOOK_PORT)
+    await site.start()
+    logging.warning(f'Listening for updates on {SETTINGS.WEBHOOK_HOST}:{SETTINGS.WEBHOOK_PORT}{SETTINGS.WEBHOOK_PATH}')
+    return runner
@@ -0,0 +1,116 @@
+import os
+import asyncio
+import hashlib
+
+from uuid import uuid4
+from gridfs.errors import FileExists
+from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from .mongodb import MongoDB
+
+class BlobStore:
+    '''
+    Content-addressed storage of binary data.
+    Blobs are keyed by the sha256 of their content, equal data is stored once.
+    '''
+
+    @staticmethod
+    def get_key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    async def put(self, data: bytes, content_type: str) -> str:
+        '''
+        Stores the data and returns its key
+        '''
+        raise NotImplementedError
+
+    async def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+class FileBlobStore(BlobStore):
+    '''
+    Stores blobs in the local filesystem as `<root>/<key[:2]>/<key>`
+    '''
+    root: str
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def __write(self, key: str, data: bytes):
+        path = self.__path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique per write, concurrent writes of the same key do not share the file
+        tmp_path = f'{path}.{uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def __read(self, key: str) -> bytes:
+        with open(self.__path(key), 'rb') as file:
+            return file.read()
+
+    async def put(self, data: bytes, content_type: str) -> str:
+        key = self.get_key(data)
+        await asyncio.to_thread(self.__write, key, data)
+        return key
+
+    async def get(self, key: str) -> bytes:
+        return await asyncio.to_thread(self.__read, key)
+
+class GridFSBlobStore(BlobStore):
+    '''
+    Stores blobs in MongoDB GridFS with the key as file id
+    '''
+    bucket_name: str
+
+    def __init__(self, bucket_name: str = 'blobs') -> None:
+        self.bucket_name = bucket_name
+
+    def __bucket(self) -> AsyncIOMotorGridFSBucket:
+        return AsyncIOMotorGridFSBucket(MongoDB.get_database(), bucket_name=self.bucket_name)
+
+    async def put(self, data: bytes, content_type: str) -> str:
+        key = self.get_key(data)
+        files = MongoDB.get_database()[f'{self.bucket_name}.files']
+        if await files.find_one({"_id": key}, projection={"_id": True}) is None:
+            # GridFS accepts only bytes or file objects
+            if not isinstance(data, bytes):
+                data = bytes(data)
+            try:
+                await self.__bucket().upload_from_stream_with_id(
+                    key, key, data, metadata={"content_type": content_type}
+                )
+            except (FileExists, DuplicateKeyError):
+                # Stored by a concurrent put of the same data
+                pass
+        return key
+
+    async def get(self, key: str) -> bytes:
+        stream = await self.__bucket().open_download_stream(key)
+        return await stream.read()
+
+class Blobs:
+    store: BlobStore
+
+    @classmethod
+    def setup(cls, store: BlobStore) -> None:
+        cls.store = store
+
+    @classmethod
+    async def put(cls, data: bytes, content_type: str) -> str:
+        return await cls.store.put(data, content_type)
+
+    @classmethod
+    async def get(cls, key: str) -> bytes:
+        return await cls.store.get(key)
@@ -1,139 +1,337 @@
-# TODO: Переделать под OrderedDict (LRU)
-# *удалять при этом под lock'ом
-
 import io
+import asyncio
+import logging
 
-from asyncio import Lock
+from time import monotonic
+from typing import Any, Awaitable, Callable, Tuple, Union
+from uuid import uuid4
+from collections import OrderedDict
 from datetime import datetime
-from aiogram.types import User
+from bson import ObjectId
+from aiogram import Bot
+from aiogram.types import User, ChatMember
+from aiogram.enums.chat_member_status import ChatMemberStatus
+
+from app.settings import SETTINGS
 
 from .mongodb import MongoDB
-from .mongo_user import UserData, Settings, Statistics
-from .enums import UserRole, ActionOption
+from .writer import BulkWriter
+from .mongo_user import UserData, register_user_changed_handler, register_quota_taken_handler
+
+_MISSING = object()
 
-class UserCache:
+CACHE_CHANNEL = 'cache:users'
+
+class LRUCache:
     '''
-    Represents the bot user's cache.
+    Bounded LRU cache with per-entry TTL.
+    Concurrent loads of the same key are coalesced into a single call.
     '''
-    aiogram_user: User
-    db_user: UserData
-    lock: Lock
-
-    def __init__(self, user: User) -> None:
-        self.user = user
-        self.db_user = None
-        self.lock = Lock()
-
-    @property
-    def banned(self) -> bool:
-        return self.db_user.banned
-
-    @property
-    def role(self) -> UserRole:
-        return self.db_user.role
-
-    @property
-    def settings(self) -> Settings:
-        return self.db_user.settings
-
-    @property
-    def statistics(self) -> Statistics:
-        return self.db_user.statistics
-
-    async def load(self):
-        '''
-        Loads or creates a user in the database.
-        Locks an object when in use.
-        '''
-        async with self.lock:
-            if self.db_user is not None:
-                return
-            data = await MongoDB.get_user(self.user.id)
-            if data:
-                self.db_user = UserData(**data)
-                self.db_user.last_update = datetime.now()
-                self.db_user.username = self.user.username
-                self.db_user.first_name = self.user.first_name
-                self.db_user.last_name = self.user.last_name
-                await self.save()
-            if self.db_user is None:
-                self.db_user = UserData(
-                    _id = None,
-                    user_id = self.user.id,
-                    reg_date = datetime.now(),
-                    last_update = datetime.now(),
-                    username = self.user.username,
-                    first_name = self.user.first_name,
-                    last_name = self.user.last_name
-                )
-                result = await MongoDB.get_database().tg_users.insert_one(self.db_user.as_dict())
-            data = await MongoDB.get_user(self.user.id)
-            self.db_user = UserData(**data)
+    max_size: int
+    ttl: float
+    entries: OrderedDict
+    loading: dict
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    async def save(self):
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, value = entry
+        if expires < monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
         '''
-        Saves stored_data in the database.
+        Returns the value without counting a hit or refreshing its position
         '''
-        await MongoDB.update_user(self.db_user.as_dict())
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl: float = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        self.entries[key] = (monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key) -> None:
+        self.entries.pop(key, None)
+        # A load in progress may return stale data, do not store it
+        self.loading.pop(key, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.loading.clear()
+
+    async def get_or_load(self, key, loader: Callable[[], Awaitable[Any]], ttl: Union[float, Callable[[Any], float]] = None):
+        '''
+        Returns the cached value or awaits `loader()` once for all
+        concurrent callers. `None` results are not stored.
+        `ttl` may be a function of the loaded value.
+        '''
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        future = self.loading.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        try:
+            value = await loader()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark as retrieved if nobody waits for it
+            future.exception()
+            raise
+        finally:
+            is_current = self.loading.get(key) is future
+            if is_current:
+                del self.loading[key]
+        if is_current and value is not None:
+            self.set(key, value, ttl(value) if callable(ttl) else ttl)
+        future.set_result(value)
+        return value
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def items(self):
+        return list(self.entries.items())
+
+    def get_stats(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
 
 class Cache:
-    __cache = {}
+    '''
+    In-process cache of `UserData` keyed by telegram user id.
+    With a shared redis set up, invalidations and the quota taken are published
+    to `CACHE_CHANNEL` and applied by the caches of all bot workers.
+    '''
+    __users = LRUCache(SETTINGS.USER_CACHE_SIZE, SETTINGS.USER_CACHE_TTL)
     __last_purge = datetime.now()
+    __redis = None
+    __worker_id = uuid4().hex
+
+    @classmethod
+    def setup_sync(cls, redis):
+        cls.__redis = redis
+
+    @classmethod
+    def is_synced(cls) -> bool:
+        return cls.__redis is not None
+
+    @classmethod
+    def __publish(cls, *message):
+        if cls.__redis is None:
+            return
+        data = ' '.join(str(part) for part in (cls.__worker_id, *message))
+        asyncio.get_running_loop().create_task(cls.__redis.publish(CACHE_CHANNEL, data))
 
     @classmethod
-    async def get_user(cls, user) -> UserCache:
+    def __apply(cls, data: str):
+        worker_id, action, *args = data.split(' ')
+        if worker_id == cls.__worker_id:
+            return
+        if action == 'purge':
+            cls.__users.clear()
+            cls.__last_purge = datetime.now()
+        elif action == 'user':
+            cls.__users.invalidate(int(args[0]))
+        elif action == 'id':
+            cls.__invalidate_id(ObjectId(args[0]))
+        elif action == 'quota':
+            cls.__take_quota(int(args[0]), int(args[1]), args[2])
+
+    @classmethod
+    def __take_quota(cls, user_id: int, difference: int, statistic: str):
+        user_data = cls.__users.peek(user_id)
+        if user_data is None:
+            # A load in progress may have read the quota before it was taken
+            cls.__users.invalidate(user_id)
+            return
+        user_data.subscription.take_quota(difference)
+        setattr(user_data.statistics, statistic, getattr(user_data.statistics, statistic) + 1)
+
+    @classmethod
+    async def sync_loop(cls):
         '''
-        Get the user from the cache. Loads if it was not found.
+        Applies the invalidations of other workers, runs forever
         '''
-        user_cache = cls.__cache.get(user.id)
-        if user_cache is None:
-            user_cache = UserCache(user)
-            await user_cache.load()
-        cls.__cache[user.id] = user_cache
-        return user_cache
-        
+        while True:
+            try:
+                async with cls.__redis.pubsub() as pubsub:
+                    await pubsub.subscribe(CACHE_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message['type'] != 'message':
+                            continue
+                        data = message['data']
+                        cls.__apply(data.decode() if isinstance(data, bytes) else data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'User cache sync failed: {e!r}')
+                # Invalidations may be lost while disconnected
+                cls.__users.clear()
+                await asyncio.sleep(SETTINGS.REDIS_RETRY_INTERVAL)
+
+    @classmethod
+    async def get_user(cls, user: User) -> Tuple[UserData, bool]:
+        '''
+        Get the user from the cache. Loads or creates it if it was not found.
+        Returns the user data and True if the user was created by this call.
+        '''
+        created = False
+
+        async def load() -> UserData:
+            nonlocal created
+            if BulkWriter.is_pending('tg_users', user.id):
+                # The quota and statistics taken by this worker are not written yet
+                await BulkWriter.flush()
+            data = await MongoDB.get_user(user.id)
+            if data is not None:
+                user_data = UserData(**data)
+            else:
+                user_data = UserData(
+                    _id = None,
+                    user_id = user.id,
+                    reg_date = datetime.now(),
+                    last_update = datetime.now(),
+                    username = user.username,
+                    first_name = user.first_name,
+                    last_name = user.last_name
+                )
+                result = await MongoDB.get_database().tg_users.insert_one(user_data.as_dict())
+                user_data.set_id(result.inserted_id)
+                created = True
+            return user_data
+
+        user_data = await cls.__users.get_or_load(user.id, load)
+        return user_data, created
+
     @classmethod
     async def purge(cls):
         '''
-        Force clears the cache. 
-        Use at your own risk, may cause errors.
-        '''
-        items = list(cls.__cache.items())
-        cls.__cache = {}
-        for key, value in items:
-            async with value.lock:
-                try:
-                    del cls.__cache[key]
-                except Exception as error:
-                    pass
+        Force clears the cache.
+        '''
+        cls.__users.clear()
         cls.__last_purge = datetime.now()
+        cls.__publish('purge')
 
     @classmethod
     async def clear_user(cls, user_id):
         '''
-        Force clears the cache for a user. 
-        Use at your own risk, may cause errors.
+        Force clears the cache for a user.
+        '''
+        cls.__users.invalidate(user_id)
+        cls.__publish('user', user_id)
+
+    @classmethod
+    def __invalidate_id(cls, _id: ObjectId):
+        for user_id, (expires, user_data) in cls.__users.items():
+            if user_data._id == _id:
+                cls.__users.invalidate(user_id)
+
+    @classmethod
+    def invalidate(cls, _id: ObjectId):
+        '''
+        Drops the user with the database `_id` from the cache.
+        Called by `UserData` and `Settings` setters.
         '''
-        if (cls.__cache.get(user_id) is not None):
-            del cls.__cache[user_id]
+        cls.__invalidate_id(_id)
+        cls.__publish('id', _id)
+
+    @classmethod
+    def quota_taken(cls, user_id: int, difference: int, statistic: str):
+        '''
+        Sends the quota taken from the snapshot of this worker to the other workers.
+        Called by `UserData.take_quota_buffered`.
+        '''
+        cls.__publish('quota', user_id, difference, statistic)
 
     @classmethod
     def get_size(cls):
-        return len(cls.__cache.keys())
-    
+        return len(cls.__users)
+
     @classmethod
     def get_last_purge(cls):
         return cls.__last_purge
-    
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        return cls.__users.get_stats()
+
     @classmethod
     async def get_cache_contents(cls) -> io.StringIO:
         '''
         Get the cache contents as StringIO.
         '''
         buffer = io.StringIO()
-        i = 0
-        items = list(cls.__cache.items())
-        for key, value in items:
-            buffer.write(f'({i}) {key} {value.data.as_dict()}\n')
-            i += 1
-        return buffer
\ No newline at end of file
+        for i, (key, (expires, value)) in enumerate(cls.__users.items()):
+            buffer.write(f'({i}) {key} {value.as_dict()}\n')
+        return buffer
+
+class Membership:
+    '''
+    Cache of the channel membership checked before text requests.
+    Members are cached for MEMBERSHIP_TTL, non-members for the shorter
+    MEMBERSHIP_NEGATIVE_TTL so a fresh subscription is noticed soon.
+    `chat_member` updates of the channel refresh the entry at once.
+    '''
+    __members = LRUCache(SETTINGS.USER_CACHE_SIZE, SETTINGS.MEMBERSHIP_TTL)
+
+    @staticmethod
+    def is_member_status(member: ChatMember) -> bool:
+        return member is not None and member.status not in [ChatMemberStatus.KICKED, ChatMemberStatus.LEFT, ChatMemberStatus.RESTRICTED]
+
+    @staticmethod
+    def get_ttl(is_member: bool) -> float:
+        return SETTINGS.MEMBERSHIP_TTL if is_member else SETTINGS.MEMBERSHIP_NEGATIVE_TTL
+
+    @classmethod
+    async def is_member(cls, bot: Bot, user_id: int) -> bool:
+        async def load() -> bool:
+            member = await bot.get_chat_member(SETTINGS.MEMBERSHIP_CHANNEL_ID, user_id)
+            return cls.is_member_status(member)
+
+        return await cls.__members.get_or_load(user_id, load, cls.get_ttl)
+
+    @classmethod
+    def update(cls, user_id: int, member: ChatMember):
+        '''
+        Called with the new member state from `chat_member` updates
+        '''
+        is_member = cls.is_member_status(member)
+        cls.__members.invalidate(user_id)
+        cls.__members.set(user_id, is_member, cls.get_ttl(is_member))
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        return cls.__members.get_stats()
+
+register_user_changed_handler(Cache.invalidate)
+register_quota_taken_handler(Cache.quota_taken)
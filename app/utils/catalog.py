@@ -0,0 +1,50 @@
+import asyncio
+import logging
+
+from typing import Dict
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+
+from .mongodb import MongoDB
+
+class SubscriptionCatalog:
+    '''
+    In-process copy of the `subscriptions` collection indexed by name and `_id`.
+    Loaded at startup and reloaded on every change of the collection,
+    or periodically if change streams are not available (no replica set).
+    '''
+    by_name: Dict[str, dict] = {}
+    by_id: Dict[ObjectId, dict] = {}
+
+    @classmethod
+    async def load(cls):
+        subscriptions = await MongoDB.get_database().subscriptions.find().to_list(length=None)
+        # Replaced at once, readers never see a partially loaded catalog
+        cls.by_name = {sub['name']: sub for sub in subscriptions}
+        cls.by_id = {sub['_id']: sub for sub in subscriptions}
+
+    @classmethod
+    def get_by_name(cls, name: str) -> dict:
+        return cls.by_name.get(name)
+
+    @classmethod
+    def get_by_id(cls, _id: ObjectId) -> dict:
+        return cls.by_id.get(ObjectId(_id))
+
+    @classmethod
+    async def watch(cls, interval: float):
+        '''
+        Keeps the catalog up to date, runs forever
+        '''
+        try:
+            async with MongoDB.get_database().subscriptions.watch() as stream:
+                async for change in stream:
+                    await cls.load()
+        except PyMongoError as e:
+            logging.warning(f'Subscriptions change stream is not available ({e!r}), reloading every {interval}s')
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await cls.load()
+            except PyMongoError as e:
+                logging.error(f'Failed to reload subscriptions: {e!r}')
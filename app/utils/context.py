@@ -0,0 +1,77 @@
+import tiktoken
+
+from typing import Dict, List, Tuple
+from tiktoken.model import MODEL_TO_ENCODING, MODEL_PREFIX_TO_ENCODING
+
+# Tokens added by the chat format to every message
+MESSAGE_TOKENS = 4
+# Models unknown to tiktoken (gemini) are estimated with it
+DEFAULT_ENCODING = 'cl100k_base'
+# Used until the encoding is loaded, overestimates so the context still fits
+BYTES_PER_TOKEN = 4
+
+encodings: Dict[str, tiktoken.Encoding] = {}
+
+def load_encodings(names: List[str] = [DEFAULT_ENCODING]):
+    '''
+    Loads the encodings, downloads them unless TIKTOKEN_CACHE_DIR has them.
+    Blocking, called on startup in a thread.
+    The text models of the bot (gpt-3.5-turbo, gpt-4, gemini) all use cl100k_base.
+    '''
+    for name in names:
+        encodings[name] = tiktoken.get_encoding(name)
+
+def get_encoding_name(model: str) -> str:
+    if model in MODEL_TO_ENCODING:
+        return MODEL_TO_ENCODING[model]
+    for prefix, name in MODEL_PREFIX_TO_ENCODING.items():
+        if model.startswith(prefix):
+            return name
+    return DEFAULT_ENCODING
+
+def count_tokens(text: str, model: str) -> int:
+    '''
+    Counts with the model encoding if it is loaded, never loads it in the event loop
+    '''
+    encoding = encodings.get(get_encoding_name(model))
+    if encoding is None:
+        return MESSAGE_TOKENS + len(text.encode('utf-8')) // BYTES_PER_TOKEN + 1
+    return MESSAGE_TOKENS + len(encoding.encode(text))
+
+def get_turn_tokens(turn: dict, model: str) -> int:
+    tokens = turn.get('tokens')
+    if tokens is None:
+        tokens = count_tokens(turn['text'], model)
+    return tokens
+
+def build_context(
+        turns: List[dict],
+        prompt: str,
+        max_tokens: int,
+        model: str,
+        system: str = None
+    ) -> Tuple[List[dict], int]:
+    '''
+    Selects the most recent dialogue turns ({role, text}) that fit into `max_tokens`
+    together with the system prompt and the new prompt.\n
+    Returns the context ending with the prompt and its token count.
+    '''
+    head = []
+    if system is not None:
+        head.append({"role": "system", "text": system})
+    tail = [{"role": "user", "text": prompt}]
+    used = sum(get_turn_tokens(turn, model) for turn in head + tail)
+
+    selected = []
+    for turn in reversed(turns):
+        tokens = get_turn_tokens(turn, model)
+        if used + tokens > max_tokens:
+            break
+        used += tokens
+        selected.append(turn)
+    selected.reverse()
+    # Context should start with a user turn
+    while selected and selected[0]['role'] != 'user':
+        used -= get_turn_tokens(selected.pop(0), model)
+
+    return head + selected + tail, used
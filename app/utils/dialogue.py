@@ -0,0 +1,122 @@
+from bson import ObjectId
+from typing import List, Tuple
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+
+from .mongodb import MongoDB
+from .writer import BulkWriter
+from .context import count_tokens, build_context
+
+class DialogueStore:
+    '''
+    Stores dialogues as append-only turns.\n
+    `dialogue_turns`: {dialogue_id, seq, parent_id, chat_id, message_id, role, text, tokens, model}\n
+    `dialogues`: {_id, user, chat_id, model, last_seq}\n
+    A reply to the last turn of a dialogue continues it, a reply to an earlier
+    turn starts a new dialogue whose first turn points to that turn by `parent_id`.
+    `message_id` is a list when the answer was split into several messages.
+    '''
+
+    @classmethod
+    async def setup(cls):
+        db = MongoDB.get_database()
+        await db.dialogue_turns.create_index([("chat_id", ASCENDING), ("message_id", ASCENDING)])
+        await db.dialogue_turns.create_index([("dialogue_id", ASCENDING), ("seq", ASCENDING)])
+
+    @classmethod
+    async def get_history(cls, chat_id: int, message_id: int, model: str, max_turns: int) -> Tuple[dict, List[dict]]:
+        '''
+        Returns the turn with `message_id` and up to `max_turns` turns ending with it,
+        (None, []) if there is no such turn of the `model`.
+        '''
+        db = MongoDB.get_database()
+        turn = await db.dialogue_turns.find_one({"chat_id": chat_id, "message_id": message_id})
+        if turn is None or turn.get('model') != model:
+            return None, []
+        history = []
+        current = turn
+        while current is not None and len(history) < max_turns:
+            limit = max_turns - len(history)
+            cursor = db.dialogue_turns.find(
+                filter = {"dialogue_id": current['dialogue_id'], "seq": {"$lte": current['seq']}},
+                projection = {"role": True, "text": True, "tokens": True, "seq": True, "parent_id": True}
+            ).sort("seq", DESCENDING).limit(limit)
+            segment = await cursor.to_list(length=limit)
+            history.extend(segment)
+            current = None
+            # The whole dialogue was read and it is a branch of another one
+            if segment and len(segment) < limit and segment[-1]['parent_id'] is not None:
+                current = await db.dialogue_turns.find_one({"_id": segment[-1]['parent_id']})
+        history.reverse()
+        return turn, history
+
+    @classmethod
+    async def get_context(
+            cls,
+            chat_id: int,
+            message_id: int,
+            model: str,
+            prompt: str,
+            max_tokens: int,
+            max_turns: int,
+            system: str = None
+        ) -> Tuple[dict, List[dict], int]:
+        '''
+        Returns the replied turn (or None), the context ({role, text}) that fits
+        into `max_tokens` ending with the prompt and its token count.
+        '''
+        parent, turns = None, []
+        if message_id is not None:
+            parent, turns = await cls.get_history(chat_id, message_id, model, max_turns)
+        context, tokens = build_context(turns, prompt, max_tokens, model, system)
+        return parent, context, tokens
+
+    @classmethod
+    async def append(cls, parent: dict, user: ObjectId, chat_id: int, model: str, turns: List[dict]) -> ObjectId:
+        '''
+        Appends `turns` ({role, text, message_id}) after the `parent` turn
+        or starts a new dialogue if `parent` is None.
+        Returns the dialogue id.
+        '''
+        db = MongoDB.get_database()
+        dialogue = None
+        if parent is not None:
+            # Continue only if parent is still the last turn
+            dialogue = await db.dialogues.find_one_and_update(
+                filter = {"_id": parent['dialogue_id'], "last_seq": parent['seq']},
+                update = {"$inc": {"last_seq": len(turns)}},
+                projection = {"_id": True},
+                return_document = ReturnDocument.AFTER
+            )
+        seq = parent['seq'] if parent is not None else 0
+        parent_id = parent['_id'] if parent is not None else None
+        if dialogue is not None:
+            dialogue_id = dialogue['_id']
+        else:
+            dialogue_id = ObjectId()
+            BulkWriter.insert('dialogues', {
+                "_id": dialogue_id,
+                "user": user,
+                "chat_id": chat_id,
+                "model": model,
+                "last_seq": seq + len(turns),
+                "created": datetime.now()
+            })
+        for turn in turns:
+            seq += 1
+            turn_id = ObjectId()
+            BulkWriter.insert('dialogue_turns', {
+                "_id": turn_id,
+                "dialogue_id": dialogue_id,
+                "seq": seq,
+                "parent_id": parent_id,
+                "chat_id": chat_id,
+                "message_id": turn.get('message_id'),
+                "role": turn['role'],
+                "text": turn['text'],
+                "tokens": count_tokens(turn['text'], model),
+                "model": model,
+                "created": datetime.now()
+            })
+            parent_id = turn_id
+        return dialogue_id
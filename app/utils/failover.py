@@ -0,0 +1,102 @@
+import logging
+
+from typing import Optional, Tuple
+from aiogram.types import Message
+
+import app.utils.gemini as gemini_backend
+import app.utils.openai as openai_backend
+
+from app.settings import SETTINGS
+from app.utils.mongo_user import UserData
+
+GEMINI = 'gemini'
+OPENAI = 'openai'
+
+BACKENDS = {
+    GEMINI: gemini_backend,
+    OPENAI: openai_backend,
+}
+
+FALLBACKS = {
+    GEMINI: OPENAI,
+    OPENAI: GEMINI,
+}
+
+def get_unhealthy_reason(backend: str) -> Optional[str]:
+    '''
+    Returns why the backend should not get new requests, None if it is healthy
+    '''
+    module = BACKENDS[backend]
+    if module.circuit_breaker.is_open:
+        return 'circuit_open'
+    if module.request_queue.get_wait() > SETTINGS.TEXT_QUEUE_WAIT_SLO:
+        return 'queue_wait'
+    if module.circuit_breaker.error_rate > SETTINGS.TEXT_FAILOVER_ERROR_RATE:
+        return 'error_rate'
+    return None
+
+def get_expected_time(backend: str) -> float:
+    '''
+    Expected time until the answer starts: current queue wait and average latency
+    '''
+    module = BACKENDS[backend]
+    return module.request_queue.get_wait() + module.circuit_breaker.latency
+
+def choose_backend(preferred: str) -> Tuple[str, Optional[dict]]:
+    '''
+    Returns the backend for a new text request and the failover info
+    if it is not the preferred one.
+    A slow or failing backend is replaced only by a healthy one that is expected to answer sooner,
+    an open circuit is replaced by any healthy backend.
+    '''
+    reason = get_unhealthy_reason(preferred)
+    if reason is None or not SETTINGS.TEXT_FAILOVER:
+        return preferred, None
+    fallback = FALLBACKS[preferred]
+    if get_unhealthy_reason(fallback) is not None:
+        return preferred, None
+    if reason != 'circuit_open' and get_expected_time(fallback) >= get_expected_time(preferred):
+        return preferred, None
+    return fallback, {
+        "from": preferred,
+        "to": fallback,
+        "reason": reason,
+        "expected_time": {
+            preferred: get_expected_time(preferred),
+            fallback: get_expected_time(fallback),
+        },
+    }
+
+async def put_text_completion(user_data: UserData, backend: str, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None) -> int:
+    '''
+    Puts the request to the preferred backend or to its fallback.\n
+    Returns the position in the queue, 0 if the user already has a request in progress
+    '''
+    backend, failover = choose_backend(backend)
+    if failover is None:
+        return await BACKENDS[backend].put_chat_completion(
+            user_data=user_data,
+            prompt=prompt,
+            answer_message=answer_message,
+            chat_id=chat_id,
+            replied_message_id=replied_message_id
+        )
+    logging.warning(f'Text request of {user_data.user_id} is sent to {backend}: {failover["reason"]}')
+    if backend == OPENAI:
+        return await openai_backend.put_chat_completion(
+            user_data=user_data,
+            prompt=prompt,
+            answer_message=answer_message,
+            chat_id=chat_id,
+            replied_message_id=replied_message_id,
+            model=SETTINGS.FAILOVER_OPENAI_MODEL,
+            failover=failover
+        )
+    return await gemini_backend.put_chat_completion(
+        user_data=user_data,
+        prompt=prompt,
+        answer_message=answer_message,
+        chat_id=chat_id,
+        replied_message_id=replied_message_id,
+        failover=failover
+    )
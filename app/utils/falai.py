@@ -6,39 +6,169 @@ import traceback
 import logging
 import asyncio
 import fal
-import base64
-import io
-from aiogram.types import BufferedInputFile, InputFile
+import re
+import json
+import random
+import hashlib
+from aiogram.types import BufferedInputFile, InputFile, InputMediaPhoto, InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from time import monotonic
+from typing import Awaitable, Callable, List, Optional, Tuple
 from datetime import datetime
 from aiogram.types import Message
 
 from app.settings import SETTINGS
-from app.utils.queue import RequestQueue, RequestLimitter
-from app.utils.mongodb import MongoDB
+from app.utils.queue import RequestQueue, RequestLimitter, RequestDispatcher, GENERAL, PREMIUM, get_tier
+from app.utils.writer import BulkWriter
+from app.utils.blobs import Blobs
+from app.utils.http import HttpClients
+from app.utils.resilience import CircuitBreaker, RetryPolicy, resilient_call, report_error
+from app.utils.images import decode_data_uri, fit_image_async
 from app.utils.mongo_user import UserData
+from app.utils.dialogue import DialogueStore
+from app.utils.gemini import to_contents
+from app.utils.cache import LRUCache
+from app.utils.prompt_rules import PromptRules, register_rules_changed_handler
 
-httpx_client = httpx.AsyncClient(proxies=SETTINGS.HTTP_PROXY.get_secret_value())
-httpx_client_no_proxy = httpx.AsyncClient()
+httpx_client = HttpClients.get("gemini")
+fal_client = HttpClients.get("fal")
+gemini_circuit_breaker = CircuitBreaker.get("gemini", SETTINGS.CIRCUIT_FAILURE_THRESHOLD, SETTINGS.CIRCUIT_RESET_TIMEOUT)
+fal_circuit_breaker = CircuitBreaker.get("fal", SETTINGS.CIRCUIT_FAILURE_THRESHOLD, SETTINGS.CIRCUIT_RESET_TIMEOUT)
+retry_policy = RetryPolicy(SETTINGS.PROVIDER_RETRY_ATTEMPTS, max_delay=SETTINGS.PROVIDER_RETRY_MAX_DELAY)
 
-request_queue = RequestQueue((1, 2))
+LIMITTER_BACKEND = 'image'
 
-async def put_chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None):
-    print("_chat_completion task prestart")
-    global request_queue
-    if not (await RequestLimitter.put(user_data.user_id, 1)):
-        return False
-    data = {
+# Telegram sends at most 10 photos in a media group
+MEDIA_GROUP_LIMIT = 10
+
+# Parameters of the generated images, also a part of the image cache key
+GENERATION_PARAMS = {
+    "model_name": "runwayml/stable-diffusion-v1-5",
+    "negative_prompt": "nsfw, nude, sexual",
+    "image_size": "square",
+    "num_inference_steps": 12,
+    "guidance_scale": 1.5,
+    "enable_safety_checker": True,
+    "safety_checker_version": "v1",
+    "format": "jpeg",
+}
+
+# Normalized user prompt -> {contents, sd_prompt, loras}
+rewrite_cache = LRUCache(SETTINGS.IMAGINE_CACHE_SIZE, SETTINGS.IMAGINE_CACHE_TTL)
+# get_image_key() -> {file_id, prompt, contents, sd_prompt, loras}
+image_cache = LRUCache(SETTINGS.IMAGINE_CACHE_SIZE, SETTINGS.IMAGINE_CACHE_TTL)
+# Rewrites depend on the rules, they are dropped when the rules change
+register_rules_changed_handler(rewrite_cache.clear)
+
+# Imagine pipeline: prompt rewrite -> image generation -> upload,
+# every stage has its own queue and workers
+request_queue = RequestQueue(
+    weights={
+        GENERAL: SETTINGS.QUEUE_GENERAL_WEIGHT,
+        PREMIUM: SETTINGS.QUEUE_PREMIUM_WEIGHT,
+    },
+    max_wait=SETTINGS.QUEUE_MAX_WAIT
+)
+generate_queue = RequestQueue(
+    weights={
+        GENERAL: SETTINGS.QUEUE_GENERAL_WEIGHT,
+        PREMIUM: SETTINGS.QUEUE_PREMIUM_WEIGHT,
+    },
+    max_wait=SETTINGS.QUEUE_MAX_WAIT
+)
+upload_queue = RequestQueue(
+    weights={
+        GENERAL: SETTINGS.QUEUE_GENERAL_WEIGHT,
+        PREMIUM: SETTINGS.QUEUE_PREMIUM_WEIGHT,
+    },
+    max_wait=SETTINGS.QUEUE_MAX_WAIT
+)
+
+def normalize_prompt(prompt: str) -> str:
+    '''
+    Prompts that differ only in case, punctuation or spacing are the same
+    '''
+    return ' '.join(re.findall(r'\w+', prompt.casefold().replace('ё', 'е')))
+
+def get_image_key(sd_prompt: str, loras: List[dict]) -> str:
+    '''
+    Returns the key of the image generated with these parameters
+    '''
+    params = json.dumps([sd_prompt, loras, GENERATION_PARAMS], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()[:32]
+
+def get_num_images(user_data: UserData, num_images: int = None) -> int:
+    '''
+    Returns the number of images for the request, limited by the quota left
+    and by the media group size
+    '''
+    if num_images is None:
+        num_images = SETTINGS.IMAGINE_NUM_IMAGES
+    return max(1, min(num_images, user_data.subscription.quota, MEDIA_GROUP_LIMIT))
+
+def _new_job(lease: str, user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None, num_images: int = None) -> dict:
+    return {
+        "lease": lease,
         "user_data": user_data,
         "prompt": prompt,
         "answer_message": answer_message,
-        "chat_id": chat_id,
-        "replied_message_id": replied_message_id
+        "chat_id": chat_id if chat_id is not None else user_data.user_id,
+        "replied_message_id": replied_message_id,
+        "num_images": get_num_images(user_data, num_images),
+        "tier": get_tier(user_data),
+        "enqueued": monotonic(),
+        "timings": {}
     }
-    request_queue.put_general(("chat_completion", data,))
-    return True
+
+async def put_chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None, num_images: int = None) -> int:
+    '''
+    Returns the position in the queue, 0 if the user already has a request in progress.\n
+    `num_images` variants are generated in one call, IMAGINE_NUM_IMAGES by default.
+    A prompt seen before skips the rewrite stage, and the generation too
+    if a single image is requested and it is still cached.
+    '''
+    global request_queue
+    lease = await RequestLimitter.put(user_data.user_id, SETTINGS.IMAGE_REQUESTS_PER_USER, LIMITTER_BACKEND)
+    if lease is None:
+        return 0
+    job = _new_job(lease, user_data, prompt, answer_message, chat_id, replied_message_id, num_images)
+    # Replies depend on the dialogue, they are not cached
+    rewrite = rewrite_cache.get(normalize_prompt(prompt)) if replied_message_id is None else None
+    if rewrite is None:
+        return request_queue.put(("job", {"job": job},), job['tier'])
+    job.update(rewrite)
+    image = image_cache.get(get_image_key(job['sd_prompt'], job['loras'])) if job['num_images'] == 1 else None
+    if image is None:
+        return generate_queue.put(("job", {"job": job},), job['tier'])
+    job['cached_file_id'] = image['file_id']
+    return upload_queue.put(("job", {"job": job},), job['tier'])
+
+async def put_variation(user_data: UserData, image_key: str, answer_message: Message, chat_id: str = None, num_images: int = None) -> Optional[int]:
+    '''
+    Generates a new image for the prompt of a cached image with another seed.\n
+    Returns the position in the queue, 0 if the user already has a request in progress
+    and None if the image is no longer cached.
+    '''
+    image = image_cache.get(image_key)
+    if image is None:
+        return None
+    lease = await RequestLimitter.put(user_data.user_id, SETTINGS.IMAGE_REQUESTS_PER_USER, LIMITTER_BACKEND)
+    if lease is None:
+        return 0
+    job = _new_job(lease, user_data, image['prompt'], answer_message, chat_id, num_images=num_images)
+    job.update({
+        "contents": image['contents'],
+        "sd_prompt": image['sd_prompt'],
+        "loras": image['loras'],
+        "seed": random.randrange(2 ** 32)
+    })
+    return generate_queue.put(("job", {"job": job},), job['tier'])
 
 async def _chat_completion_request(contents: list):
+    return await resilient_call(gemini_circuit_breaker, lambda: _chat_completion_call(contents), retry_policy)
+
+async def _chat_completion_call(contents: list):
     response = await httpx_client.post(
         url=f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key={SETTINGS.GEMINI_API_KEY.get_secret_value().strip()}",
         headers={"Content-Type": "application/json"},
@@ -62,136 +192,251 @@ async def _chat_completion_request(contents: list):
                 "threshold": "BLOCK_NONE",
                 },
             ],
-        },
-        timeout=60
+        }
     )
     if response.status_code != 200:
         print(response.content)
-        raise httpx.HTTPStatusError(response.status_code, response.content)
+    response.raise_for_status()
     return response
 
-async def _chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None):
-    print("_chat_completion task")
+async def _generate_image_request(prompt: str, loras: List[dict], seed: int = None, num_images: int = 1):
+    return await resilient_call(fal_circuit_breaker, lambda: _generate_image_call(prompt, loras, seed, num_images), retry_policy)
+
+async def _generate_image_call(prompt: str, loras: List[dict], seed: int = None, num_images: int = 1):
+    data = {
+        **GENERATION_PARAMS,
+        "prompt": prompt,
+        "sync_mode": True,
+        "num_images": num_images,
+        "loras": loras,
+        # The first lora in the old format
+        "LoraWeight": loras[0] if loras else {
+            "path": "",
+            "scale": 1
+        }
+    }
+    if seed is not None:
+        data["seed"] = seed
+    response = await fal_client.post(
+        url=f"https://fal.run/fal-ai/fast-lcm-diffusion",
+        headers={"Content-Type": "application/json", "Authorization": f"Key {SETTINGS.FAL_AI_API_KEY.get_secret_value().strip()}"},
+        json=data
+    )
+    response.raise_for_status()
+    return response
+
+async def _run_stage(stage: str, job: dict, step: Callable[[dict], Awaitable], next_queue: RequestQueue = None):
+    '''
+    Runs one step of the job and passes the job to the next stage.
+    The user request slot is released when the last stage is done or any stage fails,
+    before the error is shown, so a failed error message does not keep it.
+    '''
+    started = job['started'] = monotonic()
     try:
-        contents = []
-        # If chat_id is None
-        if chat_id is None:
-            chat_id = user_data.user_id
-        # If replied_message_id is not None
-        if replied_message_id is not None:
-            response = await MongoDB.db.completions.find_one({"chat_id": chat_id, "message_id": replied_message_id})
-            if response is not None and response.get('model') == 'gemini-pro':
-                contents = response.get('contents', contents)
-        # If replied_message_id is None - first message
-        else:
-            prompt = f"""
+        await step(job)
+    except Exception as e:
+        await RequestLimitter.pop(job['user_data'].user_id, job['lease'], LIMITTER_BACKEND)
+        await report_error(job['answer_message'], e)
+        return
+    finally:
+        job['timings'][stage] = {"wait": started - job['enqueued'], "run": monotonic() - started}
+    if next_queue is None:
+        await RequestLimitter.pop(job['user_data'].user_id, job['lease'], LIMITTER_BACKEND)
+        return
+    job['enqueued'] = monotonic()
+    next_queue.put(("job", {"job": job},), job['tier'])
+
+async def _rewrite_prompt(job: dict):
+    prompt = job['prompt']
+    # If replied_message_id is None - first message
+    if job['replied_message_id'] is None:
+        prompt = f"""
 Act as stable diffusion prompt generator. Answer only prompts in plain text and carefully follow this instruction.\n
 Translate all words to english. Only use english. Do not use verbs, write tags.\n
 User input: {prompt}\n
 Add style keywords as: photorealistic, 4k, best quality
 Final prompt:\n"""
-        contents.append({"role": "user", "parts":[{"text": prompt}]})
-        print("Contents: ", contents)
-        # Request
-        response = await _chat_completion_request(contents)
-        print(response.json())
-        response_text = response.json()['candidates'][0]['content']['parts'][0]['text']
-        total_tokens = 0
-        contents.append({"role": "model", "parts":[{"text": response_text}]})
-
-        print("Response text: ", response_text)
-
-        # Заменить таганрог
-        response_text = response_text.replace("Taganrog", "Taganrog a city with a harbor")
-        response_text = response_text.replace("taganrog", "Taganrog a city with a harbor")
-        response_text = response_text.replace("Таганрог", "Taganrog a city with a harbor")
-        response_text = response_text.replace("таганрог", "Taganrog a city with a harbor")
-
-        loraUrl = ""
-
-        if response_text.find("corpus g") != -1:
-            loraUrl = "https://ictis.ru/corpus_g.safetensors"
-        elif response_text.find("Taganrog") != -1:
-            loraUrl = "https://github.com/AlexBSoft/sd-models/raw/main/KamennayaLestnica_400s_lr0002_512px.safetensors"
-        elif response_text.find("KamennayaLestnica") != -1:
-            loraUrl = "https://github.com/AlexBSoft/sd-models/raw/main/KamennayaLestnica_400s_lr0002_512px.safetensors"
-        
-
-        await answer_message.edit_text(response_text)
-        # Отправляем response_text в генератор изображений
-        result = await httpx_client_no_proxy.post(
-            url=f"https://fal.run/fal-ai/fast-lcm-diffusion",
-            headers={"Content-Type": "application/json", "Authorization": f"Key {SETTINGS.FAL_AI_API_KEY.get_secret_value().strip()}"},
-            json={
-                "model_name": "runwayml/stable-diffusion-v1-5",
-                "prompt": response_text, 
-                "negative_prompt": "nsfw, nude, sexual",
-                "image_size": "square",
-                "num_inference_steps": 12,
-                "guidance_scale": 1.5,
-                "sync_mode": True,
-                "num_images": 1,
-                "enable_safety_checker": True,
-                "safety_checker_version": "v1",
-                "format": "jpeg",
-                "LoraWeight": {
-                    "path": loraUrl,
-                    "scale": 1
-                }
-            },
-            timeout=60
-        )
-        falai_res = result.json()['images']
-        print("falai result: ", falai_res)
-        
-        # falai_res[0]["url"] is base64 encoded image string
-
-        image_buf = io.BytesIO(base64.b64decode(falai_res[0]["url"].replace("data:image/jpeg;base64,", "")))
-        image = BufferedInputFile(file=image_buf.getvalue(), filename="image.jpg")
-        
-        newmessage = await answer_message.answer_photo(photo=image, caption=response_text, parse_mode="Markdown")
-        await answer_message.delete()
-        #await answer_message.
-        #await bot.send_photo(chat_id=chat_id, photo=falai_res[0])
-
-        # Save
-        await MongoDB.db.completions.insert_one({
+    # A reply continues the gemini dialogue, the same way the text requests do
+    _, context, _ = await DialogueStore.get_context(
+        chat_id=job['chat_id'],
+        message_id=job['replied_message_id'],
+        model='gemini-pro',
+        prompt=prompt,
+        max_tokens=SETTINGS.CHAT_COMPLETION_MAX_TOKENS,
+        max_turns=SETTINGS.DIALOGUE_MAX_TURNS
+    )
+    contents = to_contents(context)
+    # Request
+    response = await _chat_completion_request(contents)
+    response_text = response.json()['candidates'][0]['content']['parts'][0]['text']
+    contents.append({"role": "model", "parts":[{"text": response_text}]})
+
+    # Landmark keywords and loras
+    response_text, loras = PromptRules.apply(response_text)
+
+    await job['answer_message'].edit_text(response_text)
+    job['contents'] = contents
+    job['sd_prompt'] = response_text
+    job['loras'] = loras
+    if job['replied_message_id'] is None:
+        rewrite_cache.set(normalize_prompt(job['prompt']), {
+            "contents": contents,
+            "sd_prompt": response_text,
+            "loras": loras
+        })
+
+async def _generate_image(job: dict):
+    # Отправляем response_text в генератор изображений
+    result = await _generate_image_request(job['sd_prompt'], job['loras'], job.get('seed'), job['num_images'])
+    job['images'] = result.json()['images']
+
+def _get_variation_markup(image_key: str) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔄 Новая вариация", callback_data=f"imagine_variation:{image_key}")
+    return kb.as_markup()
+
+async def _delete_placeholder(job: dict):
+    try:
+        await job['answer_message'].delete()
+    except Exception as e:
+        logging.error(f'Failed to delete the imagine placeholder: {e!r}')
+
+async def _upload_cached_image(job: dict):
+    user_data = job['user_data']
+    image_key = get_image_key(job['sd_prompt'], job['loras'])
+    newmessage = await job['answer_message'].answer_photo(
+        photo=job['cached_file_id'],
+        caption=job['sd_prompt'],
+        parse_mode="Markdown",
+        reply_markup=_get_variation_markup(image_key)
+    )
+    # The image is delivered, errors are only logged
+    await _delete_placeholder(job)
+    try:
+        # Save, served from the cache without generation, the quota is not taken
+        job['timings']['upload'] = {"wait": job['started'] - job['enqueued'], "run": monotonic() - job['started']}
+        BulkWriter.insert('completions', {
             "user": user_data._id,
-            "chat_id": chat_id,
+            "chat_id": job['chat_id'],
             "message_id": newmessage.message_id,
             "created": datetime.now(),
             "model": "iamgine",
             "image_generator": "falai",
-            "total_tokens": total_tokens,
-            "contents": contents,
-            "falai_res": falai_res[0]
+            "total_tokens": 0,
+            "contents": job['contents'],
+            "falai_res": {"file_id": job['cached_file_id'], "cache_key": image_key, "cached": True},
+            "timings": dict(job['timings'])
         })
-        await user_data.statistics.inc_text_prompts()
-        await user_data.take_quota(1)
-        # Return
-        #await answer_message.edit_text(response_text, parse_mode="Markdown")
     except Exception as e:
-        logging(f'{e}\n{traceback.format_exc()}')
-        await answer_message.edit_text("Произошла ошибка. Попробуйте еще раз.")
-        raise e
-    finally:
-        await RequestLimitter.pop(user_data.user_id)
+        logging.error(f'Failed to save the completion: {e}\n{traceback.format_exc()}')
 
+async def _decode_image(falai_image: dict) -> Tuple[bytes, str]:
+    '''
+    Returns the image and its content type, decoded in a thread
+    '''
+    # falai_image["url"] is base64 encoded image string, decoded once and uploaded as is
+    image_bytes = await asyncio.to_thread(decode_data_uri, falai_image["url"])
+    content_type = falai_image.get("content_type", "image/jpeg")
+    if len(image_bytes) > SETTINGS.IMAGE_MAX_BYTES:
+        image_bytes = await fit_image_async(image_bytes, SETTINGS.IMAGE_MAX_SIDE, SETTINGS.IMAGE_MAX_BYTES)
+        content_type = "image/jpeg"
+    return image_bytes, content_type
 
+async def _upload_image(job: dict):
+    if 'cached_file_id' in job:
+        return await _upload_cached_image(job)
+    user_data = job['user_data']
+    falai_res = job['images']
+    image_key = get_image_key(job['sd_prompt'], job['loras'])
+    decoded = await asyncio.gather(*(_decode_image(falai_image) for falai_image in falai_res))
+
+    if len(decoded) == 1:
+        newmessages = [await job['answer_message'].answer_photo(
+            photo=BufferedInputFile(file=decoded[0][0], filename="image.jpg"),
+            caption=job['sd_prompt'],
+            parse_mode="Markdown",
+            reply_markup=_get_variation_markup(image_key)
+        )]
+    else:
+        # Media groups can not have buttons, the caption is shown under the first image
+        newmessages = await job['answer_message'].answer_media_group(media=[
+            InputMediaPhoto(
+                media=BufferedInputFile(file=image_bytes, filename=f"image_{i}.jpg"),
+                caption=job['sd_prompt'] if i == 0 else None,
+                parse_mode="Markdown"
+            )
+            for i, (image_bytes, content_type) in enumerate(decoded)
+        ])
+    # The images are delivered, every image is a request, the quota spent meanwhile caps the charge
+    user_data.take_quota_buffered(len(decoded), 'image_prompts')
+    # Saving errors are only logged
+    await _delete_placeholder(job)
+    try:
+        # Store the images by reference, telegram file_id can be used to resend them
+        blobs = await asyncio.gather(*(Blobs.put(image_bytes, content_type) for image_bytes, content_type in decoded))
+        images_info = []
+        for falai_image, blob, newmessage in zip(falai_res, blobs, newmessages):
+            image_info = {key: value for key, value in falai_image.items() if key != "url"}
+            image_info["blob"] = blob
+            image_info["file_id"] = newmessage.photo[-1].file_id
+            images_info.append(image_info)
+        # Variations are not cached, the cached image stays the answer to the prompt
+        if 'seed' not in job:
+            image_cache.set(image_key, {
+                "file_id": images_info[0]["file_id"],
+                "prompt": job['prompt'],
+                "contents": job['contents'],
+                "sd_prompt": job['sd_prompt'],
+                "loras": job['loras']
+            })
+
+        # Save, this stage is measured up to here
+        job['timings']['upload'] = {"wait": job['started'] - job['enqueued'], "run": monotonic() - job['started']}
+        completion = {
+            "user": user_data._id,
+            "chat_id": job['chat_id'],
+            "message_id": newmessages[0].message_id,
+            "created": datetime.now(),
+            "model": "iamgine",
+            "image_generator": "falai",
+            "total_tokens": 0,
+            "contents": job['contents'],
+            "falai_res": images_info[0],
+            "timings": dict(job['timings'])
+        }
+        if len(images_info) > 1:
+            completion["variants"] = images_info
+        BulkWriter.insert('completions', completion)
+    except Exception as e:
+        logging.error(f'Failed to save the completion: {e}\n{traceback.format_exc()}')
+
+async def _rewrite_stage(job: dict):
+    await _run_stage('rewrite', job, _rewrite_prompt, generate_queue)
+
+async def _generate_stage(job: dict):
+    await _run_stage('generate', job, _generate_image, upload_queue)
+
+async def _upload_stage(job: dict):
+    await _run_stage('upload', job, _upload_image)
 
 async def executor():
-    global request_queue
-    loop = asyncio.get_running_loop()
-    while True:
-        try:
-            request = await request_queue.get_request()
-            if request is None: 
-                await asyncio.sleep(0.03)
-                continue
-            type, data = request
-            if type == "chat_completion":
-                loop.create_task(_chat_completion(**data)) # TOOD: image generation
-        except Exception as e:
-            logging(f'{e}\n{traceback.format_exc()}')
-        finally:
-            await asyncio.sleep(0.2)
\ No newline at end of file
+    dispatchers = [
+        RequestDispatcher(
+            queue=request_queue,
+            handlers={"job": _rewrite_stage},
+            workers=SETTINGS.IMAGINE_REWRITE_WORKERS,
+            rate=SETTINGS.IMAGINE_REWRITE_RPS
+        ),
+        RequestDispatcher(
+            queue=generate_queue,
+            handlers={"job": _generate_stage},
+            workers=SETTINGS.FALAI_WORKERS,
+            rate=SETTINGS.FALAI_RPS
+        ),
+        RequestDispatcher(
+            queue=upload_queue,
+            handlers={"job": _upload_stage},
+            workers=SETTINGS.IMAGINE_UPLOAD_WORKERS
+        ),
+    ]
+    await asyncio.gather(*(dispatcher.run() for dispatcher in dispatchers))
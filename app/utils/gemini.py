@@ -1,162 +1,290 @@
+import json
 import httpx
 import traceback
 import logging
 import asyncio
 
 from datetime import datetime
+from typing import AsyncIterator, Tuple
 from aiogram.types import Message
 
 from app.settings import SETTINGS
-from app.utils.queue import RequestQueue, RequestLimitter
+from app.utils.queue import RequestQueue, RequestLimitter, RequestDispatcher, GENERAL, PREMIUM, get_tier
 from app.utils.mongodb import MongoDB
+from app.utils.writer import BulkWriter
+from app.utils.stream import StreamingMessage
+from app.utils.dialogue import DialogueStore
+from app.utils.context import count_tokens
+from app.utils.blobs import Blobs
+from app.utils.http import HttpClients
+from app.utils.resilience import CircuitBreaker, RetryPolicy, resilient_call, report_error
+from app.utils.images import base64_chunks, base64_length
 from app.utils.mongo_user import UserData
 
-httpx_client = httpx.AsyncClient(proxies=SETTINGS.HTTP_PROXY.get_secret_value())
+httpx_client = HttpClients.get("gemini")
+circuit_breaker = CircuitBreaker.get("gemini", SETTINGS.CIRCUIT_FAILURE_THRESHOLD, SETTINGS.CIRCUIT_RESET_TIMEOUT)
+retry_policy = RetryPolicy(SETTINGS.PROVIDER_RETRY_ATTEMPTS, max_delay=SETTINGS.PROVIDER_RETRY_MAX_DELAY, hedge_delay=SETTINGS.GEMINI_HEDGE_DELAY)
+# Streams are not hedged, the answer is already shown while it is generated
+stream_retry_policy = RetryPolicy(SETTINGS.PROVIDER_RETRY_ATTEMPTS, max_delay=SETTINGS.PROVIDER_RETRY_MAX_DELAY)
 
-request_queue = RequestQueue((1, 2))
+LIMITTER_BACKEND = 'text'
 
-async def put_chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None):
+# Placeholder of the photo data in the request body
+PHOTO_MARKER = '@photo@'
+
+# Dialogue store roles to gemini roles
+ROLES = {
+    "user": "user",
+    "assistant": "model",
+}
+
+SAFETY_SETTINGS = [
+    {
+    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+    "threshold": "BLOCK_NONE",
+    },
+    {
+    "category": "HARM_CATEGORY_HARASSMENT",
+    "threshold": "BLOCK_NONE",
+    },
+    {
+    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+    "threshold": "BLOCK_NONE",
+    },
+    {
+    "category": "HARM_CATEGORY_HATE_SPEECH",
+    "threshold": "BLOCK_NONE",
+    },
+]
+
+request_queue = RequestQueue(
+    weights={
+        GENERAL: SETTINGS.QUEUE_GENERAL_WEIGHT,
+        PREMIUM: SETTINGS.QUEUE_PREMIUM_WEIGHT,
+    },
+    max_wait=SETTINGS.QUEUE_MAX_WAIT
+)
+
+def to_contents(context: list) -> list:
+    '''
+    Converts dialogue turns to gemini contents.
+    Gemini has no system role, system texts are prepended to the next user turn.
+    '''
+    contents = []
+    system = []
+    for turn in context:
+        if turn['role'] == 'system':
+            system.append(turn['text'])
+            continue
+        text = turn['text']
+        if system and turn['role'] == 'user':
+            text = '\n\n'.join(system + [text])
+            system = []
+        contents.append({"role": ROLES[turn['role']], "parts":[{"text": text}]})
+    return contents
+
+async def put_chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None, failover: dict = None) -> int:
+    '''
+    Returns the position in the queue, 0 if the user already has a request in progress.\n
+    `failover` describes why the request was routed here from another backend.
+    '''
     global request_queue
-    if not (await RequestLimitter.put(user_data.user_id, 1)):
-        return False
+    lease = await RequestLimitter.put(user_data.user_id, SETTINGS.TEXT_REQUESTS_PER_USER, LIMITTER_BACKEND)
+    if lease is None:
+        return 0
     data = {
+        "lease": lease,
         "user_data": user_data,
         "prompt": prompt,
         "answer_message": answer_message,
         "chat_id": chat_id,
-        "replied_message_id": replied_message_id
+        "replied_message_id": replied_message_id,
+        "stream": user_data.settings.stream_mode,
+        "failover": failover
     }
-    request_queue.put_general(("chat_completion", data,))
-    return True
+    return request_queue.put(("chat_completion", data,), get_tier(user_data))
 
-async def put_analyze_photo(user_data: UserData, prompt: str, base64_photo: str, answer_message: Message, chat_id: str = None):
+async def put_analyze_photo(user_data: UserData, prompt: str, photo: memoryview, answer_message: Message, chat_id: str = None, file_id: str = None) -> int:
+    '''
+    Returns the position in the queue, 0 if the user already has a request in progress
+    '''
     global request_queue
-    if not (await RequestLimitter.put(user_data.user_id, 1)):
-        return False
+    lease = await RequestLimitter.put(user_data.user_id, SETTINGS.TEXT_REQUESTS_PER_USER, LIMITTER_BACKEND)
+    if lease is None:
+        return 0
     data = {
+        "lease": lease,
         "user_data": user_data,
         "prompt": prompt,
-        "base64_photo": base64_photo,
+        "photo": photo,
         "answer_message": answer_message,
-        "chat_id": chat_id
+        "chat_id": chat_id,
+        "file_id": file_id
     }
-    request_queue.put_general(("analyze_photo", data,))
-    return True
+    return request_queue.put(("analyze_photo", data,), get_tier(user_data))
 
 async def _chat_completion_request(contents: list):
+    return await resilient_call(circuit_breaker, lambda: _chat_completion_call(contents), retry_policy)
+
+async def _chat_completion_call(contents: list):
     response = await httpx_client.post(
         url=f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key={SETTINGS.GEMINI_API_KEY.get_secret_value().strip()}",
         headers={"Content-Type": "application/json"},
         json={
             "contents": contents, 
-            "safetySettings": [
-                {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_NONE",
-                },
-                {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_NONE",
-                },
-                {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_NONE",
-                },
-                {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_NONE",
-                },
-            ],
-        },
-        timeout=60
+            "safetySettings": SAFETY_SETTINGS,
+        }
     )
-    if response.status_code != 200:
-        raise httpx.HTTPStatusError(response.status_code, response.content)
+    response.raise_for_status()
     return response
 
-async def _analyze_photo_request(contents: list):
-    response = await httpx_client.post(
-        url=f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent?key={SETTINGS.GEMINI_API_KEY.get_secret_value().strip()}",
+async def _open_stream(contents: list) -> httpx.Response:
+    request = httpx_client.build_request(
+        method="POST",
+        url=f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:streamGenerateContent?alt=sse&key={SETTINGS.GEMINI_API_KEY.get_secret_value().strip()}",
         headers={"Content-Type": "application/json"},
         json={
             "contents": contents,
-            "safetySettings": [
-                {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_NONE",
-                },
-                {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_NONE",
-                },
-                {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_NONE",
-                },
-                {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_NONE",
-                },
-            ],
-        },
-        timeout=60
+            "safetySettings": SAFETY_SETTINGS,
+        }
     )
-    if response.status_code != 200:
-        raise httpx.HTTPStatusError(response.status_code, response.content)
+    response = await httpx_client.send(request, stream=True)
+    if response.is_error:
+        await response.aread()
+        await response.aclose()
+        response.raise_for_status()
     return response
 
-async def _chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None):
+async def _chat_completion_stream_request(contents: list):
+    '''
+    Yields text parts of the answer as they are generated.
+    Only opening the stream is retried.
+    '''
+    response = await resilient_call(circuit_breaker, lambda: _open_stream(contents), stream_retry_policy)
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = json.loads(line[len("data:"):])
+            for candidate in data.get('candidates', [])[:1]:
+                for part in candidate.get('content', {}).get('parts', []):
+                    yield part.get('text', '')
+    finally:
+        await response.aclose()
+
+def _analyze_photo_body(prompt: str, photo: memoryview) -> Tuple[AsyncIterator[bytes], int]:
+    '''
+    Returns the request body and its length.
+    The photo is encoded to base64 by chunks while the body is sent,
+    the whole base64 string is never built.
+    '''
+    body = json.dumps({
+        "contents": [{"role": "user", "parts":[{"text": prompt}, {"inline_data": {"mime_type":"image/jpeg","data": PHOTO_MARKER}}]}],
+        "safetySettings": SAFETY_SETTINGS,
+    }).encode('utf-8')
+    # The photo goes after the prompt, so the last marker is the placeholder
+    head, tail = body.rsplit(PHOTO_MARKER.encode('utf-8'), 1)
+
+    async def iterator():
+        yield head
+        async for chunk in base64_chunks(photo):
+            yield chunk
+        yield tail
+
+    return iterator(), len(head) + base64_length(len(photo)) + len(tail)
+
+async def _analyze_photo_request(prompt: str, photo: memoryview):
+    return await resilient_call(circuit_breaker, lambda: _analyze_photo_call(prompt, photo), retry_policy)
+
+async def _analyze_photo_call(prompt: str, photo: memoryview):
+    content, length = _analyze_photo_body(prompt, photo)
+    response = await httpx_client.post(
+        url=f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent?key={SETTINGS.GEMINI_API_KEY.get_secret_value().strip()}",
+        headers={"Content-Type": "application/json", "Content-Length": str(length)},
+        content=content
+    )
+    response.raise_for_status()
+    return response
+
+async def _chat_completion(lease: str, user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None, stream: bool = False, failover: dict = None):
     try:
-        contents = []
         # If chat_id is None
         if chat_id is None:
             chat_id = user_data.user_id
-        # If replied_message_id is not None
-        if replied_message_id is not None:
-            response = await MongoDB.db.completions.find_one({"chat_id": chat_id, "message_id": replied_message_id})
-            if response is not None and response.get('model') == 'gemini-pro':
-                contents = response.get('contents', contents)
-        contents.append({"role": "user", "parts":[{"text": prompt}]})
+        # History that fits into the token budget
+        parent, context, prompt_tokens = await DialogueStore.get_context(
+            chat_id=chat_id,
+            message_id=replied_message_id,
+            model='gemini-pro',
+            prompt=prompt,
+            max_tokens=SETTINGS.CHAT_COMPLETION_MAX_TOKENS,
+            max_turns=SETTINGS.DIALOGUE_MAX_TURNS
+        )
+        contents = to_contents(context)
+        streaming_message = StreamingMessage(answer_message, SETTINGS.CHAT_COMPLETION_STREAM_INTERVAL)
         # Request
-        response = await _chat_completion_request(contents)
-        print(response.json())
-        response_text = response.json()['candidates'][0]['content']['parts'][0]['text']
-        total_tokens = 0
-        contents.append({"role": "model", "parts":[{"text": response_text}]})
-        # Save
-        await MongoDB.db.completions.insert_one({
+        if stream:
+            response_text = ""
+            async for text in _chat_completion_stream_request(contents):
+                response_text += text
+                await streaming_message.update(response_text)
+        else:
+            response = await _chat_completion_request(contents)
+            response_text = response.json()['candidates'][0]['content']['parts'][0]['text']
+        total_tokens = prompt_tokens + count_tokens(response_text, 'gemini-pro')
+        # Return
+        await streaming_message.finish(response_text)
+    except Exception as e:
+        await report_error(answer_message, e)
+        return
+    finally:
+        await RequestLimitter.pop(user_data.user_id, lease, LIMITTER_BACKEND)
+    # The answer is delivered, saving errors are only logged
+    user_data.take_quota_buffered(1)
+    try:
+        dialogue_id = await DialogueStore.append(parent, user_data._id, chat_id, 'gemini-pro', [
+            {"role": "user", "text": prompt},
+            {"role": "assistant", "text": response_text, "message_id": streaming_message.message_ids},
+        ])
+        BulkWriter.insert('completions', {
             "user": user_data._id,
             "chat_id": chat_id,
             "message_id": answer_message.message_id,
             "created": datetime.now(),
             "model": "gemini-pro",
             "total_tokens": total_tokens,
-            "contents": contents
+            "dialogue_id": dialogue_id,
+            "failover": failover
         })
-        await user_data.statistics.inc_text_prompts()
-        await user_data.take_quota(1)
-        # Return
-        await answer_message.edit_text(response_text, parse_mode="Markdown")
     except Exception as e:
-        logging(f'{e}\n{traceback.format_exc()}')
-        await answer_message.edit_text("Произошла ошибка. Попробуйте еще раз.")
-        raise e
-    finally:
-        await RequestLimitter.pop(user_data.user_id)
+        logging.error(f'Failed to save the completion: {e}\n{traceback.format_exc()}')
 
-async def _analyze_photo(user_data: UserData, prompt: str, base64_photo: str, answer_message: Message, chat_id: str = None):
+async def _analyze_photo(lease: str, user_data: UserData, prompt: str, photo: memoryview, answer_message: Message, chat_id: str = None, file_id: str = None):
     try:
-        contents = [{"role": "user", "parts":[{"text": prompt}, {"inline_data": {"mime_type":"image/jpeg","data": base64_photo}}]}]
         # If chat_id is None
         if chat_id is None:
             chat_id = user_data.user_id
         # Request
-        response = await _analyze_photo_request(contents)
+        response = await _analyze_photo_request(prompt, photo)
         response_text = response.json()['candidates'][0]['content']['parts'][0]['text']
         total_tokens = 0
-        contents.append({"role": "model", "parts":[{"text": response_text}]})
-        # Save
-        await MongoDB.db.completions.insert_one({
+        # Return
+        await StreamingMessage(answer_message, SETTINGS.CHAT_COMPLETION_STREAM_INTERVAL).finish(response_text)
+    except Exception as e:
+        await report_error(answer_message, e)
+        return
+    finally:
+        await RequestLimitter.pop(user_data.user_id, lease, LIMITTER_BACKEND)
+    # The answer is delivered, saving errors are only logged
+    user_data.take_quota_buffered(1)
+    try:
+        # Save the photo by reference
+        blob = await Blobs.put(photo, "image/jpeg")
+        contents = [
+            {"role": "user", "parts":[{"text": prompt}, {"blob": {"mime_type": "image/jpeg", "key": blob, "file_id": file_id}}]},
+            {"role": "model", "parts":[{"text": response_text}]}
+        ]
+        BulkWriter.insert('completions', {
             "user": user_data._id,
             "chat_id": chat_id,
             "message_id": answer_message.message_id,
@@ -165,33 +293,17 @@ async def _analyze_photo(user_data: UserData, prompt: str, base64_photo: str, an
             "total_tokens": total_tokens,
             "contents": contents
         })
-        await user_data.statistics.inc_text_prompts()
-        await user_data.take_quota(1)
-        # Return
-        await answer_message.edit_text(response_text, parse_mode="Markdown")
     except Exception as e:
-        logging(f'{e}\n{traceback.format_exc()}')
-        await answer_message.edit_text("Произошла ошибка. Попробуйте еще раз.")
-        raise e
-    finally:
-        await RequestLimitter.pop(user_data.user_id)
+        logging.error(f'Failed to save the completion: {e}\n{traceback.format_exc()}')
 
 async def executor():
-    global request_queue
-    loop = asyncio.get_running_loop()
-    while True:
-        try:
-            request = await request_queue.get_request()
-            if request is None: 
-                await asyncio.sleep(0.03)
-                continue
-            type, data = request
-            if type == "chat_completion":
-                loop.create_task(_chat_completion(**data))
-            elif type == "analyze_photo":
-                loop.create_task(_analyze_photo(**data))
-        except Exception as e:
-            logging(f'{e}\n{traceback.format_exc()}')
-        finally:
-            await asyncio.sleep(0.2)
-        
\ No newline at end of file
+    dispatcher = RequestDispatcher(
+        queue=request_queue,
+        handlers={
+            "chat_completion": _chat_completion,
+            "analyze_photo": _analyze_photo,
+        },
+        workers=SETTINGS.GEMINI_WORKERS,
+        rate=SETTINGS.GEMINI_RPS
+    )
+    await dispatcher.run()
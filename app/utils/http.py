@@ -0,0 +1,208 @@
+import httpx
+
+from time import monotonic
+from typing import Dict
+from httpx_socks import AsyncProxyTransport
+
+from app.settings import SETTINGS
+
+try:
+    import h2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+class PoolStats:
+    '''
+    Requests of one provider.
+    A request holds its connection until the response is closed,
+    so `in_use` is the number of connections in use.
+    '''
+    requests: int
+    errors: int
+    in_use: int
+    max_in_use: int
+    wait_total: float
+    wait_max: float
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    def acquired(self, wait: float):
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def get_stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "wait_avg": self.wait_total / self.requests if self.requests else 0,
+            "wait_max": self.wait_max,
+        }
+
+class MeteredStream(httpx.AsyncByteStream):
+    '''
+    Response stream that releases the request in the stats when closed
+    '''
+
+    def __init__(self, stream: httpx.AsyncByteStream, stats: PoolStats) -> None:
+        self.stream = stream
+        self.stats = stats
+        self.closed = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.stats.in_use -= 1
+        await self.stream.aclose()
+
+class MeteredTransport(httpx.AsyncBaseTransport):
+    '''
+    Counts requests in use and the time spent waiting for a connection.
+    The wait ends with the first connection event traced by httpcore:
+    either a new connection is opened or the request is sent on a pooled one.
+    '''
+    transport: httpx.AsyncBaseTransport
+    stats: PoolStats
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: PoolStats) -> None:
+        self.transport = transport
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = monotonic()
+        waiting = True
+        parent_trace = request.extensions.get("trace")
+
+        async def trace(event_name: str, info: dict):
+            nonlocal waiting
+            if waiting:
+                waiting = False
+                self.stats.acquired(monotonic() - start)
+            if parent_trace is not None:
+                await parent_trace(event_name, info)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        self.stats.requests += 1
+        self.stats.in_use += 1
+        self.stats.max_in_use = max(self.stats.max_in_use, self.stats.in_use)
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception:
+            self.stats.errors += 1
+            self.stats.in_use -= 1
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=MeteredStream(response.stream, self.stats),
+            extensions=response.extensions
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+class HttpClients:
+    '''
+    Registry of shared http clients, one connection pool per provider.\n
+    `gemini`: Google AI through HTTP_PROXY, also used by the imagine prompt rewrite\n
+    `openai`: OpenAI through SOCKS_PROXY\n
+    `fal`: fal.ai\n
+    `yookassa`: payments
+    '''
+    clients: Dict[str, httpx.AsyncClient] = {}
+    stats: Dict[str, PoolStats] = {}
+
+    @staticmethod
+    def get_options() -> Dict[str, dict]:
+        '''
+        Pool options of the providers, pools are sized by the workers using them
+        '''
+        return {
+            "gemini": {
+                "proxy": SETTINGS.HTTP_PROXY.get_secret_value(),
+                "max_connections": SETTINGS.GEMINI_WORKERS + SETTINGS.IMAGINE_REWRITE_WORKERS,
+                "http2": True,
+            },
+            "openai": {
+                "socks_proxy": SETTINGS.SOCKS_PROXY.get_secret_value(),
+                "max_connections": SETTINGS.OPENAI_WORKERS,
+                "http2": False,
+            },
+            "fal": {
+                "max_connections": SETTINGS.FALAI_WORKERS,
+                "http2": True,
+            },
+            "yookassa": {
+                "max_connections": 4,
+                "http2": False,
+            },
+        }
+
+    @classmethod
+    def __create(cls, name: str) -> httpx.AsyncClient:
+        options = cls.get_options()[name]
+        max_connections = options['max_connections']
+        http2 = options['http2'] and HTTP2
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=SETTINGS.HTTP_KEEPALIVE_EXPIRY
+        )
+        if options.get('socks_proxy'):
+            transport = AsyncProxyTransport.from_url(
+                options['socks_proxy'],
+                http2=http2,
+                limits=limits
+            )
+        else:
+            proxy = options.get('proxy')
+            transport = httpx.AsyncHTTPTransport(
+                http2=http2,
+                proxy=httpx.Proxy(proxy) if proxy else None,
+                limits=limits
+            )
+        stats = cls.stats.setdefault(name, PoolStats())
+        return httpx.AsyncClient(
+            transport=MeteredTransport(transport, stats),
+            timeout=httpx.Timeout(
+                connect=SETTINGS.HTTP_CONNECT_TIMEOUT,
+                read=SETTINGS.HTTP_READ_TIMEOUT,
+                write=SETTINGS.HTTP_READ_TIMEOUT,
+                pool=SETTINGS.HTTP_POOL_TIMEOUT
+            )
+        )
+
+    @classmethod
+    def get(cls, name: str) -> httpx.AsyncClient:
+        '''
+        Returns the client of the provider, created on first use
+        '''
+        client = cls.clients.get(name)
+        if client is None or client.is_closed:
+            client = cls.clients[name] = cls.__create(name)
+        return client
+
+    @classmethod
+    async def close(cls):
+        '''
+        Closes all pools, called on bot shutdown
+        '''
+        clients, cls.clients = cls.clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, dict]:
+        return {name: stats.get_stats() for name, stats in cls.stats.items()}
@@ -0,0 +1,101 @@
+import io
+import base64
+import asyncio
+
+from typing import AsyncIterator, List
+from PIL import Image
+from aiogram import Bot
+from aiogram.types import PhotoSize
+
+# Multiple of 3, so chunks are encoded to base64 without padding
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+class ByteBuffer:
+    '''
+    Writable buffer allocated once for the expected size.
+    `view()` returns the written data without copying.
+    '''
+    buffer: bytearray
+    position: int
+    length: int
+
+    def __init__(self, size: int = 0) -> None:
+        self.buffer = bytearray(size)
+        self.position = 0
+        self.length = 0
+
+    def write(self, data) -> int:
+        end = self.position + len(data)
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(end - len(self.buffer)))
+        self.buffer[self.position:end] = data
+        self.position = end
+        self.length = max(self.length, end)
+        return len(data)
+
+    def seek(self, position: int, whence: int = 0) -> int:
+        self.position = position
+        return position
+
+    def flush(self):
+        # Called by `Bot.download` after every chunk, nothing is buffered
+        pass
+
+    def view(self) -> memoryview:
+        return memoryview(self.buffer)[:self.length]
+
+def select_photo(photos: List[PhotoSize], max_side: int) -> PhotoSize:
+    '''
+    Returns the largest photo size that fits into `max_side`, the smallest one otherwise
+    '''
+    fits = [photo for photo in photos if max(photo.width, photo.height) <= max_side]
+    if fits:
+        return max(fits, key=lambda photo: photo.width * photo.height)
+    return min(photos, key=lambda photo: photo.width * photo.height)
+
+def fit_image(data, max_side: int, max_bytes: int) -> bytes:
+    '''
+    Downscales the image to `max_side` and encodes it to JPEG of at most `max_bytes`
+    '''
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((max_side, max_side))
+    image = image.convert('RGB')
+    quality = 90
+    while True:
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality)
+        if output.tell() <= max_bytes or quality <= 30:
+            return output.getvalue()
+        quality -= 15
+
+async def fit_image_async(data, max_side: int, max_bytes: int) -> bytes:
+    return await asyncio.to_thread(fit_image, data, max_side, max_bytes)
+
+async def download_photo(bot: Bot, photos: List[PhotoSize], max_side: int, max_bytes: int) -> memoryview:
+    '''
+    Downloads the best fitting photo size into a pre-sized buffer.
+    The photo is downscaled only if it is still too large.
+    '''
+    photo = select_photo(photos, max_side)
+    buffer = ByteBuffer(photo.file_size or 0)
+    await bot.download(file=photo.file_id, destination=buffer)
+    data = buffer.view()
+    if len(data) > max_bytes or max(photo.width, photo.height) > max_side:
+        data = memoryview(await fit_image_async(data, max_side, max_bytes))
+    return data
+
+def base64_length(size: int) -> int:
+    return 4 * ((size + 2) // 3)
+
+async def base64_chunks(data: memoryview) -> AsyncIterator[bytes]:
+    '''
+    Encodes data to base64 by chunks
+    '''
+    for start in range(0, len(data), BASE64_CHUNK_SIZE):
+        yield base64.b64encode(data[start:start + BASE64_CHUNK_SIZE])
+
+def decode_data_uri(uri: str) -> bytes:
+    '''
+    Decodes a `data:<type>;base64,<data>` uri
+    '''
+    return base64.b64decode(uri[uri.index(',') + 1:])
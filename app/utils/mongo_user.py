@@ -7,6 +7,33 @@ from app.settings import SETTINGS
 
 from .enums import *
 from .mongodb import MongoDB
+from .writer import BulkWriter
+
+user_changed_handlers = []
+
+def register_user_changed_handler(handler):
+    '''
+    Registers `handler(_id)` called after user data was changed in the database.
+    '''
+    global user_changed_handlers
+    user_changed_handlers.append(handler)
+
+def user_changed(_id: ObjectId):
+    for handler in user_changed_handlers:
+        handler(_id)
+
+quota_taken_handlers = []
+
+def register_quota_taken_handler(handler):
+    '''
+    Registers `handler(user_id, difference, statistic)` called after quota was taken from a snapshot.
+    '''
+    global quota_taken_handlers
+    quota_taken_handlers.append(handler)
+
+def quota_taken(user_id: int, difference: int, statistic: str):
+    for handler in quota_taken_handlers:
+        handler(user_id, difference, statistic)
 
 class Settings:
     _id: ObjectId
@@ -64,6 +91,7 @@ class Settings:
                 path = ('settings', 'dialogue_id'), 
                 value = ObjectId(dialogue_id)
             )
+            user_changed(self._id)
             if not isinstance(result, ObjectId) and not result == None:
                 raise ValueError('[set_dialogue_id] Value returned from db is incorrect!')
         self.dialogue_id = result
@@ -75,6 +103,7 @@ class Settings:
                 path = ('settings', 'stream_mode'), 
                 value = stream_mode
             )
+            user_changed(self._id)
             if not isinstance(result, bool) and not result == None:
                 raise ValueError('[set_stream_mode] Value returned from db is incorrect!')
         self.stream_mode = result
@@ -86,6 +115,7 @@ class Settings:
                 path = ('settings', 'document'), 
                 value = document
             )
+            user_changed(self._id)
             if not isinstance(result, str) and not result == None:
                 raise ValueError('[set_document] Value returned from db is incorrect!')
         self.document = result
@@ -97,6 +127,7 @@ class Settings:
                 path = ('settings', 'gpt_role'), 
                 value = gpt_role
             )
+            user_changed(self._id)
             if not isinstance(result, str) and not result == None:
                 raise ValueError('[set_gpt_role] Value returned from db is incorrect!')
         self.gpt_role = result
@@ -108,6 +139,7 @@ class Settings:
                 path = ('settings', 'action_option'), 
                 value = option.value
             )
+            user_changed(self._id)
             option = ActionOption(result)
             if not isinstance(option, ActionOption) and not result == None:
                 raise ValueError('[set_action] Value returned from db is incorrect!')
@@ -120,6 +152,7 @@ class Settings:
                 path = ('settings', 'image_model'), 
                 value = model
             )
+            user_changed(self._id)
         if not isinstance(result, str) and not result == None:
             raise ValueError('[set_image_model] Value returned from db is incorrect!')        
         self.image_model = result
@@ -131,6 +164,7 @@ class Settings:
                 path = ('settings', 'text_model'), 
                 value = model
             )
+            user_changed(self._id)
         if not isinstance(result, str) and not result == None:
             raise ValueError('[set_text_model] Value returned from db is incorrect!')
         self.text_model = result
@@ -142,6 +176,7 @@ class Settings:
                 path = ('settings', 'dialogue_mode'), 
                 value = enabled
             )
+            user_changed(self._id)
             print(result)
             if not isinstance(result, bool) and not result == None:
                 raise ValueError('[set_dialogue_mode] Value returned from db is incorrect!')
@@ -165,16 +200,6 @@ class Statistics:
         self.image_prompts = image_prompts
         self.text_prompts = text_prompts
 
-    async def inc_text_prompts(self):
-        result = await MongoDB.increment_field(
-            _id = self._id, 
-            path = ('statistics', 'text_prompts'), 
-            value = 1
-        )
-        if not isinstance(result, int):
-            raise ValueError('[inc_text_prompts] Value returned from db is incorrect!')
-        self.text_prompts = result
-        
     def as_dict(self) -> dict:
         return {
             'image_prompts': self.image_prompts,
@@ -208,14 +233,13 @@ class Subscription:
     def is_free(self) -> bool:
         return self.name == "Бесплатная"
 
-    def take_quota(self, difference: int = 1) -> bool:
+    def take_quota(self, difference: int = 1) -> int:
         '''
-        Returns how many tokens was used
+        Takes up to `difference` from the quota, returns how much was taken
         '''
-        if self.quota < difference:
-            return False
-        self.quota -= difference
-        return True
+        taken = max(min(difference, self.quota), 0)
+        self.quota -= taken
+        return taken
     
     def has_quota(self) -> bool:
         '''
@@ -302,28 +326,35 @@ class UserData:
                 path = ('subscription', ),
                 value = self.subscription.as_dict()
             )
+            user_changed(self._id)
             if type(result) != dict:
                 raise ValueError('[add_subscription] Value returned from db is incorrect!')
             self.subscription = Subscription(self._id, **result)
 
-    async def take_quota(self, difference: int = 1) -> bool:
+    def take_quota_buffered(self, difference: int = 1, statistic: str = 'text_prompts') -> int:
         '''
-        Takes quota from subscription
-        Returns True if successful, otherwise False
+        Takes quota from the snapshot and increments `statistics.<statistic>`.
+        The database update is queued to `BulkWriter` as a single atomic operation
+        that takes `difference` or whatever is left of the quota if it is less.
+        Other snapshots of the user are updated by the `quota_taken` handlers.
+        Returns how much was taken from the snapshot
         '''
-        async with self.lock:
-            if not self.subscription.has_quota():
-                return False
-            if not self.subscription.take_quota(difference):
-                return False
-            result = await MongoDB.update_field(
-                _id = self._id,
-                path = ('subscription', ),
-                value = self.subscription.as_dict()
-            )
-            if type(result) != dict:
-                raise ValueError('[take_quota] Value returned from db is incorrect!')
-            self.subscription = Subscription(self._id, **result)
+        setattr(self.statistics, statistic, getattr(self.statistics, statistic) + 1)
+        BulkWriter.update(
+            collection = 'tg_users',
+            filter = {"_id": self._id},
+            update = [{"$set": {
+                f"statistics.{statistic}": {"$add": [{"$ifNull": [f"$statistics.{statistic}", 0]}, 1]},
+                "subscription.quota": {"$max": [
+                    {"$min": ["$subscription.quota", 0]},
+                    {"$subtract": ["$subscription.quota", difference]}
+                ]}
+            }}],
+            key = self.user_id
+        )
+        taken = self.subscription.take_quota(difference)
+        quota_taken(self.user_id, difference, statistic)
+        return taken
     
     async def set_mail(self, email: str) -> None:
         async with self.lock:
@@ -332,6 +363,7 @@ class UserData:
                 path = ('email', ),
                 value = email
             )
+            user_changed(self._id)
             if type(result) != str:
                 raise ValueError('[set_mail] Value returned from db is incorrect!')
             self.email = email
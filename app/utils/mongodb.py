@@ -5,6 +5,7 @@ from bson import ObjectId
 from typing import Iterable
 
 from datetime import datetime
+from pymongo import ReturnDocument
 from pymongo.database import Database
 from motor.motor_asyncio import AsyncIOMotorClient
 
@@ -40,15 +41,16 @@ class MongoDB:
         )
     
     @classmethod
-    async def __get_field(cls, _id: ObjectId, path: Iterable[str], value: any):
+    async def __find_and_update(cls, _id: ObjectId, path: Iterable[str], update: dict):
         '''
-        {a: {b: True} }\n
-        path to `b`: ('a', 'b')
+        Applies `update` and returns the new value at `path` in one round trip
         '''
         path_str = '.'.join(path)
-        result = await MongoDB.get_database().tg_users.find_one(
+        result = await MongoDB.get_database().tg_users.find_one_and_update(
             filter = {"_id": _id},
-            projection = {"_id": False, path_str: True}
+            update = update,
+            projection = {"_id": False, path_str: True},
+            return_document = ReturnDocument.AFTER
         )
         if result is None:
             return result
@@ -77,10 +79,8 @@ class MongoDB:
         {a: {b: True} }\n
         path to `b`: ('a', 'b')
         '''
-        await cls.__update_field(_id, path, value)
-        # await cls.set_last_update(_id)
-        result = await cls.__get_field(_id, path, value)
-        return result
+        path_str = '.'.join(path)
+        return await cls.__find_and_update(_id, path, {"$set": {path_str: value}})
     
     @classmethod
     async def increment_field(cls, _id: ObjectId, path: Iterable[str], value: any):
@@ -89,19 +89,8 @@ class MongoDB:
         path to `b`: ('a', 'b')
         '''
         path_str = '.'.join(path)
-        await MongoDB.get_database().tg_users.update_one(
-            filter = {"_id": _id}, 
-            update = {"$inc": {path_str: value}}
-        )
-        # await cls.set_last_update(_id)
-        result = await MongoDB.get_database().tg_users.find_one(
-            filter = {"_id": _id},
-            projection = {"_id": False, path_str: True}
-        )
-        for a in path:
-            result = result[a]
-        return result
-        
+        return await cls.__find_and_update(_id, path, {"$inc": {path_str: value}})
+
     @classmethod
     async def get_subscription_by_name(cls, name: str) -> dict:
         result = await cls.db.subscriptions.find_one({"name": name})
@@ -129,16 +118,6 @@ class MongoDB:
         result = await cls.db.payments.update_one({"payment_id": payment_id}, {"$set": {"status": status}})
         return result
     
-    @classmethod
-    async def get_dialogue_history(cls, dialogue_id: str):
-        result = await cls.db.gpt_logs.find_one({'_id': ObjectId(dialogue_id)})
-        return result
-    
-    @classmethod
-    async def save_dialogue(cls, data: dict):
-        result = await cls.db.gpt_logs.update_one(data)
-        return result
- 
     @classmethod
     def get_database(cls) -> Database:
         return cls.db
\ No newline at end of file
@@ -1,4 +1,3 @@
-import httpx
 import openai
 import hashlib
 import logging
@@ -7,91 +6,135 @@ import traceback
 
 from datetime import datetime
 from aiogram.types import Message
-from httpx_socks import AsyncProxyTransport
 
 from app.settings import SETTINGS
 from app.utils.mongodb import MongoDB
+from app.utils.http import HttpClients
+from app.utils.resilience import CircuitBreaker, RetryPolicy, resilient_call, report_error
+from app.utils.writer import BulkWriter
+from app.utils.stream import StreamingMessage
+from app.utils.dialogue import DialogueStore
+from app.utils.context import count_tokens
 from app.utils.mongo_user import UserData
-from app.utils.queue import RequestQueue, RequestLimitter
+from app.utils.queue import RequestQueue, RequestLimitter, RequestDispatcher, GENERAL, PREMIUM, get_tier
 
-transport = AsyncProxyTransport.from_url(SETTINGS.SOCKS_PROXY.get_secret_value())
-httpx_client = httpx.AsyncClient(transport=transport)
-client = openai.AsyncOpenAI(api_key=SETTINGS.OPENAI_KEY.get_secret_value(), http_client=httpx_client)
+httpx_client = HttpClients.get("openai")
+client = openai.AsyncOpenAI(api_key=SETTINGS.OPENAI_KEY.get_secret_value(), http_client=httpx_client, timeout=httpx_client.timeout, max_retries=0)
+circuit_breaker = CircuitBreaker.get("openai", SETTINGS.CIRCUIT_FAILURE_THRESHOLD, SETTINGS.CIRCUIT_RESET_TIMEOUT)
+retry_policy = RetryPolicy(SETTINGS.PROVIDER_RETRY_ATTEMPTS, max_delay=SETTINGS.PROVIDER_RETRY_MAX_DELAY)
 
-request_queue = RequestQueue((1, 2))
+LIMITTER_BACKEND = 'text'
 
-async def put_chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None):
+request_queue = RequestQueue(
+    weights={
+        GENERAL: SETTINGS.QUEUE_GENERAL_WEIGHT,
+        PREMIUM: SETTINGS.QUEUE_PREMIUM_WEIGHT,
+    },
+    max_wait=SETTINGS.QUEUE_MAX_WAIT
+)
+
+async def put_chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None, model: str = None, failover: dict = None) -> int:
+    '''
+    Returns the position in the queue, 0 if the user already has a request in progress.\n
+    `model` overrides the model from the user settings,
+    `failover` describes why the request was routed here from another backend.
+    '''
     global request_queue
-    if not (await RequestLimitter.put(user_data.user_id, 1)):
-        return False
+    lease = await RequestLimitter.put(user_data.user_id, SETTINGS.TEXT_REQUESTS_PER_USER, LIMITTER_BACKEND)
+    if lease is None:
+        return 0
     data = {
+        "lease": lease,
         "user_data": user_data,
         "prompt": prompt,
         "answer_message": answer_message,
         "chat_id": chat_id,
-        "replied_message_id": replied_message_id
+        "replied_message_id": replied_message_id,
+        "stream": user_data.settings.stream_mode,
+        "model": model,
+        "failover": failover
     }
-    request_queue.put_general(("chat_completion", data,))
-    return True
+    return request_queue.put(("chat_completion", data,), get_tier(user_data))
 
-async def _chat_completion(user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None):
+async def _chat_completion(lease: str, user_data: UserData, prompt: str, answer_message: Message, chat_id: str = None, replied_message_id: str = None, stream: bool = False, model: str = None, failover: dict = None):
     try:
-        history = [{"role": "system", "content": "You are a helpful assistant."}]
+        if model is None:
+            model = user_data.settings.text_model
         # If chat_id is None
         if chat_id is None:
             chat_id = user_data.user_id
-        # If replied_message_id is not None
-        if replied_message_id is not None:
-            response = await MongoDB.db.completions.find_one({"chat_id": chat_id, "message_id": replied_message_id})
-            if response is not None and response.get('model') == user_data.settings.text_model:
-                history = response.get('history', history)
+        # History that fits into the token budget
+        parent, context, prompt_tokens = await DialogueStore.get_context(
+            chat_id=chat_id,
+            message_id=replied_message_id,
+            model=model,
+            prompt=prompt,
+            max_tokens=SETTINGS.CHAT_COMPLETION_MAX_TOKENS,
+            max_turns=SETTINGS.DIALOGUE_MAX_TURNS,
+            system="You are a helpful assistant."
+        )
+        history = [{"role": turn['role'], "content": turn['text']} for turn in context]
         # Salted ID
         hashed_id = hashlib.sha256(str(user_data.user_id).encode('utf-8')).hexdigest()
-        # History
-        history.append({"role": "user", "content": prompt})
+        streaming_message = StreamingMessage(answer_message, SETTINGS.CHAT_COMPLETION_STREAM_INTERVAL)
         # Request
-        response = await client.chat.completions.create(
-            model=user_data.settings.text_model,
-            messages=history,
-            user=hashed_id
-        )
-        response_text = response.choices[0].message.content
-        total_tokens = response.usage.total_tokens
-        history.append({"role": "assistant", "content": response_text})
-        # Save
-        await MongoDB.db.completions.insert_one({
+        if stream:
+            # Only opening the stream is retried
+            response = await resilient_call(circuit_breaker, lambda: client.chat.completions.create(
+                model=model,
+                messages=history,
+                user=hashed_id,
+                stream=True
+            ), retry_policy)
+            response_text = ""
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    response_text += chunk.choices[0].delta.content
+                    await streaming_message.update(response_text)
+            # Usage is not reported for streamed responses
+            total_tokens = prompt_tokens + count_tokens(response_text, model)
+        else:
+            response = await resilient_call(circuit_breaker, lambda: client.chat.completions.create(
+                model=model,
+                messages=history,
+                user=hashed_id
+            ), retry_policy)
+            response_text = response.choices[0].message.content
+            total_tokens = response.usage.total_tokens
+        # Return
+        await streaming_message.finish(response_text)
+    except Exception as e:
+        await report_error(answer_message, e)
+        return
+    finally:
+        await RequestLimitter.pop(user_data.user_id, lease, LIMITTER_BACKEND)
+    # The answer is delivered, saving errors are only logged
+    user_data.take_quota_buffered(1)
+    try:
+        dialogue_id = await DialogueStore.append(parent, user_data._id, chat_id, model, [
+            {"role": "user", "text": prompt},
+            {"role": "assistant", "text": response_text, "message_id": streaming_message.message_ids},
+        ])
+        BulkWriter.insert('completions', {
             "user": user_data._id,
             "chat_id": chat_id,
             "message_id": answer_message.message_id,
             "created": datetime.now(),
-            "model": user_data.settings.text_model,
+            "model": model,
             "total_tokens": total_tokens,
-            "history": history
+            "dialogue_id": dialogue_id,
+            "failover": failover
         })
-        await user_data.statistics.inc_text_prompts()
-        await user_data.take_quota(1)
-        # Return
-        await answer_message.edit_text(response_text, parse_mode="Markdown")
     except Exception as e:
-        logging(f'{e}\n{traceback.format_exc()}')
-        await answer_message.edit_text("Произошла ошибка. Попробуйте еще раз.")
-        raise e
-    finally:
-        await RequestLimitter.pop(user_data.user_id)    
+        logging.error(f'Failed to save the completion: {e}\n{traceback.format_exc()}')
 
 async def executor():
-    global request_queue
-    loop = asyncio.get_running_loop()
-    while True:
-        try:
-            request = await request_queue.get_request()
-            if request is None: 
-                await asyncio.sleep(0.03)
-                continue
-            type, data = request
-            if type == "chat_completion":
-                loop.create_task(_chat_completion(**data))
-        except Exception as e:
-            logging(f'{e}\n{traceback.format_exc()}')
-        finally:
-            await asyncio.sleep(0.5)
\ No newline at end of file
+    dispatcher = RequestDispatcher(
+        queue=request_queue,
+        handlers={
+            "chat_completion": _chat_completion,
+        },
+        workers=SETTINGS.OPENAI_WORKERS,
+        rate=SETTINGS.OPENAI_RPS
+    )
+    await dispatcher.run()
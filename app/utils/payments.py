@@ -2,16 +2,17 @@ from datetime import datetime, timedelta
 import uuid
 import enum
 import base64
-import httpx
 import logging
 import asyncio
 import traceback
 
 from bson import ObjectId
 from app.utils.mongodb import MongoDB
+from app.utils.http import HttpClients
+from app.utils.catalog import SubscriptionCatalog
 from app.routers import safe_warnings_hook
 
-client = httpx.AsyncClient()
+client = HttpClients.get("yookassa")
 
 class PaymentStatus(enum.Enum):
     PENDING = "pending"
@@ -173,7 +174,7 @@ async def create_subscription_payment(
     customer_email: str = "test@mail.ru",
     redirect_url: str = "https://www.studgpt.ru/"
 ) -> YookassaPayment:
-    sub = await MongoDB.get_subscription_by_id(ObjectId(subscription_id))
+    sub = SubscriptionCatalog.get_by_id(subscription_id)
     product_name = sub.get('name')
     price = sub.get('price')
     payment =  await YookassaApi.create_payment(
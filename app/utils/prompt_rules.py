@@ -0,0 +1,133 @@
+import re
+import asyncio
+import logging
+
+from typing import List, Tuple
+from pymongo import ASCENDING
+
+from .mongodb import MongoDB
+
+KAMENNAYA_LESTNICA_LORA = "https://github.com/AlexBSoft/sd-models/raw/main/KamennayaLestnica_400s_lr0002_512px.safetensors"
+
+# Used while the `imagine_rules` collection is empty
+DEFAULT_RULES = [
+    {
+        "pattern": "taganrog|таганрог",
+        "replacement": "Taganrog a city with a harbor",
+        "loras": [{"path": KAMENNAYA_LESTNICA_LORA, "scale": 1}],
+    },
+    {
+        "pattern": "corpus g",
+        "loras": [{"path": "https://ictis.ru/corpus_g.safetensors", "scale": 1}],
+    },
+    {
+        "pattern": "KamennayaLestnica",
+        "loras": [{"path": KAMENNAYA_LESTNICA_LORA, "scale": 1}],
+    },
+]
+
+NUMBERED_BACKREFERENCE = re.compile(r'\\[1-9]')
+
+rules_changed_handlers = []
+
+def register_rules_changed_handler(handler):
+    '''
+    Registers `handler()` called after the rules were reloaded with changes.
+    '''
+    global rules_changed_handlers
+    rules_changed_handlers.append(handler)
+
+class PromptRules:
+    '''
+    Post-processing of the rewritten imagine prompts.\n
+    `imagine_rules`: {pattern, replacement, loras: [{path, scale}], enabled}\n
+    `pattern` is a case-insensitive regex, matches are replaced with `replacement` if it is set
+    and the `loras` of all matched rules are applied to the generation.
+    All rules are compiled into one regex and applied in a single pass,
+    earlier rules (by insertion order) win on overlapping matches.
+    Numbered backreferences are not supported, group numbers change in the combined regex.
+    A rule that does not compile alone or together with the previous rules is skipped.
+    '''
+    source: List[dict] = []
+    rules: List[dict] = []
+    regex: re.Pattern = None
+
+    @staticmethod
+    def join(rules: List[dict]) -> re.Pattern:
+        return re.compile(
+            '|'.join(f'(?P<r{i}>{rule["pattern"]})' for i, rule in enumerate(rules)),
+            re.IGNORECASE
+        )
+
+    @classmethod
+    def compile(cls, rules: List[dict]):
+        cls.source = rules
+        valid = []
+        regex = None
+        for rule in rules:
+            try:
+                # Escaped backslashes are not backreferences
+                if NUMBERED_BACKREFERENCE.search(rule['pattern'].replace('\\\\', '')):
+                    raise re.error('numbered backreference')
+                regex = cls.join(valid + [rule])
+            except (KeyError, TypeError, re.error) as e:
+                logging.error(f'Invalid imagine rule {rule}: {e!r}')
+                continue
+            valid.append(rule)
+        cls.rules = valid
+        cls.regex = regex
+
+    @classmethod
+    async def load(cls) -> bool:
+        '''
+        Loads the rules from the database, returns True if they changed
+        '''
+        rules = await MongoDB.get_database().imagine_rules.find(
+            filter={"enabled": {"$ne": False}},
+            projection={"_id": False, "pattern": True, "replacement": True, "loras": True},
+            sort=[("_id", ASCENDING)]
+        ).to_list(length=None)
+        if not rules:
+            rules = DEFAULT_RULES
+        if rules == cls.source:
+            return False
+        cls.compile(rules)
+        for handler in rules_changed_handlers:
+            handler()
+        return True
+
+    @classmethod
+    async def reload_loop(cls, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await cls.load():
+                    logging.warning(f'Imagine rules reloaded: {len(cls.rules)}')
+            except Exception as e:
+                logging.error(f'Failed to reload imagine rules: {e!r}')
+
+    @classmethod
+    def apply(cls, text: str) -> Tuple[str, List[dict]]:
+        '''
+        Returns the processed text and the loras ({path, scale}) of the matched rules
+        '''
+        if cls.regex is None:
+            return text, []
+        matched = []
+
+        def replace(match: re.Match) -> str:
+            rule = cls.rules[int(match.lastgroup[1:])]
+            if rule not in matched:
+                matched.append(rule)
+            return rule.get('replacement') or match.group()
+
+        text = cls.regex.sub(replace, text)
+        loras = {}
+        for rule in matched:
+            for lora in rule.get('loras', []):
+                # The same lora from several rules is applied once with the highest scale
+                scale = max(lora.get('scale', 1), loras.get(lora['path'], 0))
+                loras[lora['path']] = scale
+        return text, [{"path": path, "scale": scale} for path, scale in loras.items()]
+
+PromptRules.compile(DEFAULT_RULES)
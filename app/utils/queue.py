@@ -1,99 +1,379 @@
 import asyncio
 import logging
 
-from typing import Tuple
-from queue import Queue
+import traceback
 
-from asyncio import Lock
+from time import monotonic, time
+from uuid import uuid4
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from datetime import datetime
+from collections import deque, OrderedDict
+
+from asyncio import Event, Lock
+
+from app.settings import SETTINGS
+
+class LeaseStore:
+    '''
+    Storage of the request leases of `RequestLimitter` keyed by (user_id, backend).
+    Every lease has its own id, so releasing a lease never frees another request.
+    '''
+
+    async def put(self, key: Tuple[int, str], lease: str, max_requests: int, ttl: float) -> bool:
+        '''
+        Takes the `lease` if the key holds less than `max_requests` unexpired leases
+        '''
+        raise NotImplementedError
+
+    async def pop(self, key: Tuple[int, str], lease: str):
+        '''
+        Releases the `lease`, does nothing if it already expired
+        '''
+        raise NotImplementedError
+
+    async def get_usage(self) -> Dict[Tuple[int, str], int]:
+        raise NotImplementedError
+
+class MemoryLeaseStore(LeaseStore):
+    '''
+    Leases of this process, ordered by expiration since the ttl is the same for all.
+    Runs in the event loop thread only and needs no lock.
+    '''
+    storage: Dict[Tuple[int, str], OrderedDict]
+
+    def __init__(self) -> None:
+        self.storage = {}
+
+    def _expire(self, key: Tuple[int, str], now: float) -> OrderedDict:
+        leases = self.storage.get(key)
+        if leases is None:
+            return None
+        while leases and next(iter(leases.values())) <= now:
+            leases.popitem(last=False)
+            logging.warning(f'Request lease of {key} expired')
+        if not leases:
+            del self.storage[key]
+            return None
+        return leases
+
+    async def put(self, key: Tuple[int, str], lease: str, max_requests: int, ttl: float) -> bool:
+        now = monotonic()
+        leases = self._expire(key, now)
+        if leases is None:
+            leases = OrderedDict()
+        if len(leases) >= max_requests:
+            return False
+        leases[lease] = now + ttl
+        self.storage[key] = leases
+        return True
+
+    async def pop(self, key: Tuple[int, str], lease: str):
+        leases = self.storage.get(key)
+        if leases is None:
+            return
+        leases.pop(lease, None)
+        if not leases:
+            del self.storage[key]
+
+    async def get_usage(self) -> Dict[Tuple[int, str], int]:
+        now = monotonic()
+        for key in list(self.storage.keys()):
+            self._expire(key, now)
+        return {key: len(leases) for key, leases in self.storage.items()}
+
+class RedisLeaseStore(LeaseStore):
+    '''
+    Leases shared by all bot workers.
+    A key is a sorted set of lease ids scored by their expiration time,
+    the check and the put are done atomically by a script.
+    '''
+    PREFIX = 'limiter'
+    PUT_SCRIPT = '''
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+            return 0
+        end
+        redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+        redis.call('PEXPIREAT', KEYS[1], math.ceil(ARGV[3] * 1000))
+        return 1
+    '''
+
+    def __init__(self, redis) -> None:
+        self.redis = redis
+        self.put_script = redis.register_script(self.PUT_SCRIPT)
+
+    def _get_key(self, key: Tuple[int, str]) -> str:
+        return f'{self.PREFIX}:{key[0]}:{key[1]}'
+
+    async def put(self, key: Tuple[int, str], lease: str, max_requests: int, ttl: float) -> bool:
+        # Wall clock, the leases are compared between processes
+        now = time()
+        result = await self.put_script(
+            keys=[self._get_key(key)],
+            args=[now, max_requests, now + ttl, lease]
+        )
+        return result == 1
+
+    async def pop(self, key: Tuple[int, str], lease: str):
+        await self.redis.zrem(self._get_key(key), lease)
+
+    async def get_usage(self) -> Dict[Tuple[int, str], int]:
+        now = time()
+        usage = {}
+        async for name in self.redis.scan_iter(match=f'{self.PREFIX}:*'):
+            name = name.decode() if isinstance(name, bytes) else name
+            count = await self.redis.zcount(name, now, '+inf')
+            if count:
+                _, user_id, backend = name.split(':', 2)
+                usage[(int(user_id), backend)] = count
+        return usage
 
 class RequestLimitter():
-    storage: dict
-    lock: Lock
-    
+    '''
+    Limits concurrent requests of a user per backend.
+    Every request holds a lease that expires after `ttl` seconds,
+    so a slot leaked by a dead task is recovered automatically.
+    Leases are kept in this process unless a shared store is set up.
+    '''
+    store: LeaseStore
+    ttl: float
+
+    @classmethod
+    def init(cls, ttl: float):
+        cls.store = MemoryLeaseStore()
+        cls.ttl = ttl
+
     @classmethod
-    def init(cls):
-        cls.storage = {}
-        cls.lock = Lock()
+    def setup(cls, store: LeaseStore):
+        cls.store = store
 
     @classmethod
-    async def put(cls, user_id: int, max_requests: int):
-        async with cls.lock:
-            if cls.storage.get(user_id) is None:
-                cls.storage[user_id] = 0
-            if cls.storage[user_id] >= max_requests:
-                return False
-            cls.storage[user_id] += 1
-            return True
+    async def put(cls, user_id: int, max_requests: int, backend: str = 'default') -> Optional[str]:
+        '''
+        Returns the lease of the request, None if the user has too many requests in progress
+        '''
+        lease = uuid4().hex
+        if not (await cls.store.put((user_id, backend), lease, max_requests, cls.ttl)):
+            return None
+        return lease
     
     @classmethod
-    async def pop(cls, user_id: int):
-        async with cls.lock:
-            if cls.storage.get(user_id) is None:
-                return
-            cls.storage[user_id] -= 1
+    async def pop(cls, user_id: int, lease: str, backend: str = 'default'):
+        await cls.store.pop((user_id, backend), lease)
+
+    @classmethod
+    async def get_usage(cls) -> Dict[Tuple[int, str], int]:
+        '''
+        Returns the number of active requests per (user_id, backend)
+        '''
+        return await cls.store.get_usage()
+
+RequestLimitter.init(SETTINGS.REQUEST_LEASE_TTL)
 
-RequestLimitter.init()
+GENERAL = 'general'
+PREMIUM = 'premium'
+
+def get_tier(user_data) -> str:
+    '''
+    Returns the queue tier of the user by the subscription
+    '''
+    subscription = user_data.subscription
+    if subscription.is_free() or subscription.expire_datetime < datetime.now():
+        return GENERAL
+    return PREMIUM
 
 class RequestQueue():
-    general_size: int
-    premium_size: int
-    
-    general_queue: Queue
-    premium_queue: Queue
-    
+    '''
+    Weighted fair queue with a FIFO per tier.
+    Tiers are served round-robin, `weights[tier]` requests per turn.
+    Aging: a tier gets one more request per turn for every `max_wait` seconds
+    its oldest request has waited, up to twice its weight,
+    so a waiting tier catches up without losing the weighting under load.
+    '''
+    queues: Dict[str, deque]
+    weights: Dict[str, int]
+    max_wait: float
+
+    tiers: List[str]
+    current: int
+    credit: int
+    size: int
+
+    not_empty: Event
+
+    def __init__(self, weights: Dict[str, int], max_wait: float) -> None:
+        # A tier without turns would never be served and the round-robin would never stop
+        for tier, weight in weights.items():
+            if weight < 1:
+                raise ValueError(f'Queue weight of {tier} must be at least 1, got {weight}')
+        self.weights = weights
+        self.max_wait = max_wait
+        self.tiers = list(weights.keys())
+        self.queues = {tier: deque() for tier in self.tiers}
+        self.current = 0
+        self.credit = weights[self.tiers[0]]
+        self.size = 0
+        self.not_empty = Event()
+
+    def _pop(self, tier: str):
+        enqueued, request = self.queues[tier].popleft()
+        self.size -= 1
+        return request
+
+    def _get_credit(self, tier: str) -> int:
+        '''
+        Requests served in a turn of the tier, with the aging boost
+        '''
+        weight = self.weights[tier]
+        queue = self.queues[tier]
+        if not queue or self.max_wait <= 0:
+            return weight
+        boost = int((monotonic() - queue[0][0]) / self.max_wait)
+        return weight + min(boost, weight)
+
+    def get_request(self):
+        '''
+        Returns the next request or None if all queues are empty
+        '''
+        if not self.size:
+            return None
+        # Weighted round-robin, skips empty tiers
+        while True:
+            tier = self.tiers[self.current]
+            if self.credit > 0 and self.queues[tier]:
+                self.credit -= 1
+                return self._pop(tier)
+            self.current = (self.current + 1) % len(self.tiers)
+            self.credit = self._get_credit(self.tiers[self.current])
+
+    async def wait_request(self):
+        '''
+        Waits until a request is available and returns it.
+        '''
+        while not self.size:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        return self.get_request()
+
+    def get_total_size(self) -> int:
+        return self.size
+
+    def get_wait(self) -> float:
+        '''
+        Returns how long the oldest queued request has been waiting
+        '''
+        heads = [queue[0][0] for queue in self.queues.values() if queue]
+        if not heads:
+            return 0
+        return monotonic() - min(heads)
+
+    def get_size(self, tier: str) -> int:
+        return len(self.queues[tier])
+
+    def get_position(self, tier: str, index: int) -> int:
+        '''
+        Estimates the position of the `index`-th (from 1) request of the tier among all tiers:
+        it is served on the ceil(index / weight)-th turn of its tier,
+        until then every other tier is served up to its weight per turn
+        '''
+        turns = -(-index // self.weights[tier])
+        return index + sum(
+            min(len(queue), turns * self.weights[other])
+            for other, queue in self.queues.items()
+            if other != tier
+        )
+
+    def put(self, request, tier: str = GENERAL) -> int:
+        '''
+        Returns the estimated position of the request across all tiers
+        '''
+        queue = self.queues[tier]
+        queue.append((monotonic(), request))
+        self.size += 1
+        self.not_empty.set()
+        return self.get_position(tier, len(queue))
+
+    def put_general(self, request) -> int:
+        return self.put(request, GENERAL)
+
+    def put_premium(self, request) -> int:
+        return self.put(request, PREMIUM)
+
+class TokenBucket():
+    '''
+    Limits the rate of `acquire` calls to `rate` per second
+    with bursts of up to `capacity`.
+    '''
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
     lock: Lock
-    ratio: Tuple[int, int]
-    
-    def __init__(self, ratio: Tuple[int, int]) -> None:
-        self.general_size = 0
-        self.premium_size = 0
-        
-        self.general_queue = Queue()
-        self.premium_queue = Queue()
-        
-        self.ratio = ratio
-        
-        self.cur_general_count = 0
-        self.cur_premium_count = 0
 
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
         self.lock = Lock()
-    
-    async def get_request(self):
+
+    async def acquire(self):
         async with self.lock:
-            if self.cur_general_count >= self.ratio[0] and \
-                    self.cur_premium_count >= self.ratio[1]:
-                self.cur_general_count = 0
-                self.cur_premium_count = 0
-
-            if self.cur_general_count < self.ratio[0]:
-                self.cur_general_count += 1
-                if self.general_size:
-                    return self.get_general()
-            if self.cur_premium_count < self.ratio[1]:
-                self.cur_premium_count += 1
-                if self.premium_size:
-                    return self.get_premium()
-        
-            return None
-    
-    def get_total_size(self) -> int:
-        return self.general_queue.qsize() +\
-            self.premium_queue.qsize()
-    
-    def get_general(self):
-        request = self.general_queue.get_nowait()
-        self.general_size -= 1
-        return request
-    
-    def get_premium(self):
-        request = self.premium_queue.get_nowait()
-        self.premium_size -= 1
-        return request
-    
-    def put_general(self, request):
-        self.general_queue.put_nowait(request)
-        self.general_size += 1
-        
-    def put_premium(self, request):
-        self.premium_queue.put_nowait(request)
-        self.premium_size += 1
\ No newline at end of file
+            while True:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class RequestDispatcher():
+    '''
+    Runs requests from a `RequestQueue` on a fixed pool of workers.
+    At most `workers` requests are in flight, the rest wait in the queue.
+    '''
+    queue: RequestQueue
+    handlers: Dict[str, Callable[..., Awaitable]]
+    workers: int
+    bucket: TokenBucket
+    in_flight: int
+
+    def __init__(
+            self,
+            queue: RequestQueue,
+            handlers: Dict[str, Callable[..., Awaitable]],
+            workers: int = 1,
+            rate: float = None
+        ) -> None:
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.bucket = TokenBucket(rate) if rate else None
+        self.in_flight = 0
+
+    async def handle(self, type: str, data: dict):
+        handler = self.handlers.get(type)
+        if handler is None:
+            logging.error(f'Unknown request type: {type}')
+            return
+        self.in_flight += 1
+        try:
+            await handler(**data)
+        finally:
+            self.in_flight -= 1
+
+    async def worker(self):
+        while True:
+            try:
+                type, data = await self.queue.wait_request()
+                if self.bucket is not None:
+                    await self.bucket.acquire()
+                await self.handle(type, data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f'{e}\n{traceback.format_exc()}')
+
+    async def run(self):
+        await asyncio.gather(*(self.worker() for _ in range(self.workers)))
@@ -0,0 +1,83 @@
+import pytz
+import asyncio
+import logging
+
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from app.settings import SETTINGS
+from .mongodb import MongoDB
+from .writer import BulkWriter
+from .cache import Cache
+from .catalog import SubscriptionCatalog
+
+class QuotaReset:
+    '''
+    Daily quota reset, runs at midnight in `QUOTA_RESET_TIMEZONE`.\n
+    One `update_many` per subscription tier restores the quota of the users
+    whose `last_update` (the time of their last reset) is before the current period.
+    The filter makes the reset idempotent: a repeated run, another bot instance
+    or a run after downtime resets every user at most once per period.
+    '''
+
+    @classmethod
+    async def setup(cls):
+        await MongoDB.get_database().tg_users.create_index([("subscription.name", ASCENDING), ("last_update", ASCENDING)])
+
+    @staticmethod
+    def get_period_start(now: datetime = None) -> datetime:
+        '''
+        Returns the start of the current period as a naive local time,
+        the same way `last_update` is stored
+        '''
+        tz = pytz.timezone(SETTINGS.QUOTA_RESET_TIMEZONE)
+        now = (now or datetime.now()).astimezone(tz)
+        start = tz.localize(datetime(now.year, now.month, now.day))
+        return start.astimezone().replace(tzinfo=None)
+
+    @staticmethod
+    def get_next_period_start(now: datetime = None) -> datetime:
+        tz = pytz.timezone(SETTINGS.QUOTA_RESET_TIMEZONE)
+        tomorrow = (now or datetime.now()).astimezone(tz).date() + timedelta(days=1)
+        start = tz.localize(datetime(tomorrow.year, tomorrow.month, tomorrow.day))
+        return start.astimezone().replace(tzinfo=None)
+
+    @classmethod
+    async def reset(cls) -> int:
+        '''
+        Resets the quota of all users not reset in the current period,
+        returns the number of reset users
+        '''
+        period_start = cls.get_period_start()
+        # Buffered quota writes of the previous period must not apply to the new quota
+        await BulkWriter.flush()
+        users = MongoDB.get_database().tg_users
+        count = 0
+        for name, sub in SubscriptionCatalog.by_name.items():
+            result = await users.update_many(
+                filter = {"subscription.name": name, "last_update": {"$lt": period_start}},
+                update = {"$set": {"subscription.quota": sub.get('quota'), "last_update": datetime.now()}}
+            )
+            count += result.modified_count
+        if count:
+            # Cached snapshots still hold the quota of the previous period
+            await Cache.purge()
+        return count
+
+    @classmethod
+    async def reset_loop(cls):
+        '''
+        Resets on start (catches up after downtime) and then at every period start, runs forever
+        '''
+        while True:
+            try:
+                count = await cls.reset()
+                logging.warning(f'Quota reset: {count} users')
+            except PyMongoError as e:
+                logging.error(f'Failed to reset quota: {e!r}')
+                await asyncio.sleep(SETTINGS.QUOTA_RESET_RETRY_INTERVAL)
+                continue
+            delay = (cls.get_next_period_start() - datetime.now()).total_seconds()
+            # A second late, so the next run sees the new period
+            await asyncio.sleep(max(delay, 0) + 1)
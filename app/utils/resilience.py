@@ -0,0 +1,261 @@
+import httpx
+import openai
+import random
+import asyncio
+import logging
+import traceback
+
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from aiogram.types import Message
+
+T = TypeVar('T')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Weight of the last call in the moving averages
+EWMA_ALPHA = 0.2
+
+ERROR_TEXT = "Произошла ошибка. Попробуйте еще раз."
+UNAVAILABLE_TEXT = "⚠️ Сервис временно недоступен. Попробуйте позже."
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str) -> None:
+        super().__init__(f'Circuit {name} is open')
+        self.name = name
+
+class CircuitBreaker:
+    '''
+    Opens after `failure_threshold` failures in a row and fails fast while open.
+    After `reset_timeout` seconds one probe call is let through,
+    its result closes the circuit or opens it again.
+    Also keeps moving averages of the latency and the error rate of the provider.
+    The error rate also halves every `reset_timeout` seconds without calls,
+    so a provider that gets no traffic because of it recovers.
+    '''
+    breakers: Dict[str, 'CircuitBreaker'] = {}
+
+    name: str
+    failure_threshold: int
+    reset_timeout: float
+    state: str
+    failures: int
+    opened_at: float
+    probing: bool
+    latency: float
+    _error_rate: float
+    error_rate_updated: float
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.latency = 0
+        self._error_rate = 0
+        self.error_rate_updated = monotonic()
+
+    @classmethod
+    def get(cls, name: str, failure_threshold: int = 5, reset_timeout: float = 30) -> 'CircuitBreaker':
+        '''
+        Returns the breaker of the provider, created on first use
+        '''
+        if name not in cls.breakers:
+            cls.breakers[name] = cls(name, failure_threshold, reset_timeout)
+        return cls.breakers[name]
+
+    @property
+    def error_rate(self) -> float:
+        elapsed = monotonic() - self.error_rate_updated
+        return self._error_rate * 0.5 ** (elapsed / self.reset_timeout)
+
+    def __update_error_rate(self, error: float):
+        error_rate = self.error_rate
+        self._error_rate = error_rate + EWMA_ALPHA * (error - error_rate)
+        self.error_rate_updated = monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == OPEN and monotonic() - self.opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self, latency: float = None):
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+        self.__update_error_rate(0)
+        if latency is not None:
+            self.latency = latency if not self.latency else self.latency + EWMA_ALPHA * (latency - self.latency)
+
+    def release(self):
+        '''
+        The call ended without a result (cancelled), lets the next call probe
+        '''
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        self.__update_error_rate(1)
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logging.warning(f'Circuit {self.name} is open')
+            self.state = OPEN
+            self.opened_at = monotonic()
+
+    def get_stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+        }
+
+class RetryPolicy:
+    '''
+    Jittered exponential backoff, `Retry-After` of the response is honored.
+    Calls still running after `hedge_delay` seconds are duplicated
+    and the first answer wins, 0 disables hedging.
+    '''
+    attempts: int
+    base_delay: float
+    max_delay: float
+    hedge_delay: float
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10, hedge_delay: float = 0) -> None:
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_delay = hedge_delay
+
+    def get_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+def get_status_code(e: Exception) -> Optional[int]:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code
+    return None
+
+def get_retry_after(e: Exception) -> Optional[float]:
+    '''
+    Returns the `Retry-After` of the failed response in seconds
+    '''
+    response = getattr(e, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(e: Exception) -> bool:
+    '''
+    Rate limits, server errors, timeouts and connection errors are retried
+    '''
+    if isinstance(e, (httpx.TransportError, openai.APIConnectionError)):
+        return True
+    status_code = get_status_code(e)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+def get_error_text(e: Exception) -> str:
+    '''
+    Returns the error text for the user
+    '''
+    if isinstance(e, CircuitOpenError):
+        return UNAVAILABLE_TEXT
+    return ERROR_TEXT
+
+async def report_error(answer_message: Message, e: Exception):
+    '''
+    Logs the failed request and replaces the answer with the error text.
+    The answer message may be already deleted, that is only logged.
+    '''
+    logging.error(f'{e}\n{traceback.format_exc()}')
+    try:
+        await answer_message.edit_text(get_error_text(e))
+    except Exception as edit_error:
+        logging.error(f'Failed to show the error text: {edit_error!r}')
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: float) -> T:
+    '''
+    Starts a second call if the first one is not done after `delay` seconds,
+    returns the first successful result and cancels the other call
+    '''
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.append(asyncio.ensure_future(call()))
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def resilient_call(breaker: CircuitBreaker, call: Callable[[], Awaitable[T]], policy: RetryPolicy) -> T:
+    '''
+    Calls the provider with retries on transient errors.
+    Raises CircuitOpenError without calling it while the circuit is open.
+    '''
+    for attempt in range(policy.attempts):
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.name)
+        start = monotonic()
+        try:
+            if policy.hedge_delay > 0:
+                result = await hedged(call, policy.hedge_delay)
+            else:
+                result = await call()
+        except Exception as e:
+            if not is_retryable(e):
+                # The provider answered, the request itself is wrong
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= policy.attempts:
+                raise
+            delay = policy.get_delay(attempt, get_retry_after(e))
+            logging.warning(f'{breaker.name} request failed ({e!r}), retry in {delay:.1f}s')
+            await asyncio.sleep(delay)
+        except BaseException:
+            # Cancelled, a probe must not keep the circuit half open forever
+            breaker.release()
+            raise
+        else:
+            breaker.record_success(monotonic() - start)
+            return result
@@ -0,0 +1,85 @@
+from time import monotonic
+from typing import List
+
+from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def split_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    '''
+    Splits text into parts of at most `limit` chars, preferably by lines
+    '''
+    parts = []
+    while len(text) > limit:
+        index = text.rfind('\n', 0, limit)
+        if index <= 0:
+            index = limit
+        parts.append(text[:index])
+        text = text[index:].lstrip('\n')
+    parts.append(text)
+    return parts
+
+class StreamingMessage:
+    '''
+    Shows a growing answer in telegram messages.
+    Edits are coalesced and sent no more often than once per `interval` seconds,
+    text longer than the message limit continues in new messages.
+    '''
+    messages: List[Message]
+    sent: List[str]
+    interval: float
+    next_edit: float
+
+    def __init__(self, message: Message, interval: float) -> None:
+        self.messages = [message]
+        self.sent = [message.text]
+        self.interval = interval
+        self.next_edit = 0
+
+    async def __send(self, text: str, parse_mode: str = None):
+        for i, part in enumerate(split_text(text)):
+            if i < len(self.messages):
+                if self.sent[i] == part:
+                    continue
+                try:
+                    await self.messages[i].edit_text(part, parse_mode=parse_mode)
+                except TelegramBadRequest as e:
+                    if 'message is not modified' not in str(e):
+                        raise
+                self.sent[i] = part
+            else:
+                self.messages.append(await self.messages[-1].answer(part, parse_mode=parse_mode))
+                self.sent.append(part)
+
+    async def update(self, text: str):
+        '''
+        Called with the whole text received so far
+        '''
+        if not text.strip() or monotonic() < self.next_edit:
+            return
+        self.next_edit = monotonic() + self.interval
+        try:
+            await self.__send(text)
+        except TelegramRetryAfter as e:
+            self.next_edit = monotonic() + e.retry_after
+
+    async def finish(self, text: str, parse_mode: str = "Markdown"):
+        '''
+        Sends the final text, without formatting if it can not be parsed
+        '''
+        # Intermediate edits are sent without formatting, resend everything
+        self.sent = [None] * len(self.sent)
+        try:
+            await self.__send(text, parse_mode)
+        except TelegramBadRequest:
+            self.sent = [None] * len(self.sent)
+            await self.__send(text)
+
+    @property
+    def message_id(self) -> int:
+        return self.messages[0].message_id
+
+    @property
+    def message_ids(self) -> List[int]:
+        return [message.message_id for message in self.messages]
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import traceback
+
+from typing import Dict, Hashable, List, Set, Tuple
+from pymongo import InsertOne, UpdateOne
+
+from .mongodb import MongoDB
+
+class BulkWriter:
+    '''
+    Buffers database writes and sends them with one unordered `bulk_write`
+    per collection when `max_size` operations are collected
+    or every `interval` seconds.
+    Writes may be tagged with a `key`, it stays pending until the write is done,
+    so a reader can flush before loading data that is not written yet.
+    '''
+    buffer: Dict[str, List]
+    size: int
+    max_size: int
+    interval: float
+    pending: Set[Tuple[str, Hashable]]
+    flushing: Set[Tuple[str, Hashable]]
+    lock: asyncio.Lock
+
+    @classmethod
+    def setup(cls, max_size: int, interval: float):
+        cls.buffer = {}
+        cls.size = 0
+        cls.max_size = max_size
+        cls.interval = interval
+        cls.pending = set()
+        cls.flushing = set()
+        cls.lock = asyncio.Lock()
+
+    @classmethod
+    def __add(cls, collection: str, operation, key: Hashable = None):
+        cls.buffer.setdefault(collection, []).append(operation)
+        cls.size += 1
+        if key is not None:
+            cls.pending.add((collection, key))
+        if cls.size >= cls.max_size:
+            asyncio.get_running_loop().create_task(cls.flush())
+
+    @classmethod
+    def insert(cls, collection: str, document: dict):
+        cls.__add(collection, InsertOne(document))
+
+    @classmethod
+    def update(cls, collection: str, filter: dict, update: dict | list, key: Hashable = None):
+        cls.__add(collection, UpdateOne(filter, update), key)
+
+    @classmethod
+    def is_pending(cls, collection: str, key: Hashable) -> bool:
+        '''
+        Returns True if a write tagged with `key` is not done yet
+        '''
+        return (collection, key) in cls.pending or (collection, key) in cls.flushing
+
+    @classmethod
+    async def flush(cls):
+        '''
+        Writes the buffer, waits for a flush in progress first,
+        so every write queued before the call is done when it returns
+        '''
+        async with cls.lock:
+            if not cls.size:
+                return
+            buffer = cls.buffer
+            cls.buffer = {}
+            cls.size = 0
+            cls.flushing = cls.pending
+            cls.pending = set()
+            try:
+                for collection, operations in buffer.items():
+                    try:
+                        await MongoDB.get_database()[collection].bulk_write(operations, ordered=False)
+                    except Exception as e:
+                        logging.error(f'{e}\n{traceback.format_exc()}')
+            finally:
+                cls.flushing = set()
+
+    @classmethod
+    async def flush_loop(cls):
+        while True:
+            await asyncio.sleep(cls.interval)
+            await cls.flush()